@@ -0,0 +1,57 @@
+"""
+Measure how long a fresh worker takes to import the app.
+
+    python -m benchmarks.boot --runs 20
+
+Each run imports the app in a new interpreter, as a pre-fork server does
+for every worker it spawns, and reports the app's own import time along
+with the wall time of the whole process.
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+
+from benchmarks.load import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = "from posts import app; print(app.boot_seconds)"
+
+def boot(env):
+    """ Import the app in a new process, returning (import, process) time """
+    start = time.time()
+    output = subprocess.check_output([sys.executable, "-c", SCRIPT],
+                                     env=env, cwd=ROOT)
+    return float(output.strip().splitlines()[-1]), time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--config", help="CONFIG_PATH for the app")
+    parser.add_argument("--output", help="Write the results as JSON")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.config:
+        env["CONFIG_PATH"] = args.config
+    times = [boot(env) for _ in range(args.runs)]
+
+    results = {}
+    for name, values in [("import", [imported for imported, _ in times]),
+                         ("process", [process for _, process in times])]:
+        values = sorted(values)
+        results[name] = {"p50": percentile(values, 0.50),
+                         "p99": percentile(values, 0.99)}
+    for name in ["import", "process"]:
+        print("{:<8} p50 {:>8.1f} ms  p99 {:>8.1f} ms".format(
+            name, results[name]["p50"] * 1000, results[name]["p99"] * 1000))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == "__main__":
+    main()
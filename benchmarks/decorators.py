@@ -0,0 +1,67 @@
+"""
+Measure the time each decorator adds to a request.
+
+    python -m benchmarks.decorators --calls 100000
+
+Each decorator wraps a view which does nothing, called inside a request
+context, and is reported as the time per call above the bare view.
+"""
+import os
+import json
+import time
+import argparse
+
+# Configure our app to use the benchmark database
+os.environ.setdefault("CONFIG_PATH", "posts.config.BenchmarkConfig")
+
+from flask import Response
+
+from posts import app
+from posts import decorators
+
+def view():
+    return Response("[]", 200, mimetype="application/json")
+
+def decorated_views():
+    """ The views to time, each wrapped by a single decorator """
+    return [
+        ("none", view),
+        ("accept", decorators.accept("application/json")(view)),
+        ("require", decorators.require("application/json")(view)),
+        ("rate_limit", decorators.rate_limit()(view)),
+        ("concurrency_limit", decorators.concurrency_limit()(view))
+    ]
+
+def time_calls(func, calls):
+    """ Average seconds per call of a function """
+    start = time.time()
+    for _ in range(calls):
+        func()
+    return (time.time() - start) / calls
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--calls", type=int, default=100000)
+    parser.add_argument("--output", help="Write the results as JSON")
+    args = parser.parse_args()
+
+    # Enable the limits, with a rate no benchmark run can use up
+    app.config["RATE_LIMIT"] = (1e9, 1e9)
+    app.config["MAX_IN_FLIGHT"] = 1000
+
+    results = {}
+    headers = [("Accept", "application/json"),
+               ("Content-Type", "application/json")]
+    with app.test_request_context("/api/posts", headers=headers):
+        baseline = time_calls(view, args.calls)
+        for name, func in decorated_views():
+            overhead = time_calls(func, args.calls) - baseline
+            results[name] = overhead
+            print("{:<20}{:>10.2f} us".format(name, overhead * 1e6))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
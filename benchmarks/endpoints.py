@@ -0,0 +1,212 @@
+"""
+Benchmark the posts endpoints against a seeded database.
+
+    python -m benchmarks.endpoints run --posts 100000 --output new.json
+    python -m benchmarks.endpoints compare old.json new.json
+
+The database is BENCHMARK_DATABASE_URI, a local SQLite file by default.
+Requests are made in-process through the Flask test client, or over HTTP
+to a running server with --url.  The resident memory of the server is
+recorded after each scenario, for a server on this machine when its
+process id is given with --server-pid.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import subprocess
+
+# Configure our app to use the benchmark database
+os.environ.setdefault("CONFIG_PATH", "posts.config.BenchmarkConfig")
+
+from posts import app
+from posts import models
+from posts import pagination
+from posts.database import Base, engine
+from benchmarks.load import run, http_client
+
+WORDS = ["bells", "whistles", "python", "flask", "database", "index",
+         "cursor", "stream", "search", "cache", "post", "title", "body"]
+
+def generate_posts(count, seed=0):
+    """ Generate the same 'count' posts for the same seed """
+    generator = random.Random(seed)
+    # Count without building a list, which matters for millions of posts
+    number = 0
+    while number < count:
+        title = " ".join(generator.choice(WORDS) for _ in range(4))
+        body = " ".join(generator.choice(WORDS)
+                        for _ in range(generator.randint(10, 120)))
+        yield {"title": "{} {}".format(title, number)[:128],
+               "body": body[:1024]}
+        number += 1
+
+def seed(count, batch_size=10000):
+    """
+    Recreate the tables and insert 'count' posts in batches, unless the
+    database already holds exactly that many posts
+    """
+    table = models.Post.__table__
+    if table.exists(engine):
+        existing = engine.execute(table.count()).scalar()
+        if existing == count:
+            return
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    batch = []
+    for post in generate_posts(count):
+        batch.append(post)
+        if len(batch) == batch_size:
+            engine.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        engine.execute(table.insert(), batch)
+
+def scenarios(count, stream):
+    """ The endpoint and filter combinations to measure, with their paths """
+    generator = random.Random(1)
+    middle = pagination.encode_cursor([count // 2])
+    scenarios = [
+        ("posts_get", ["/api/posts"]),
+        ("posts_get_max_page", ["/api/posts?limit=500"]),
+        ("posts_get_deep_page", ["/api/posts?cursor={}".format(middle)]),
+        ("posts_get_title_like", ["/api/posts?title_like={}".format(word)
+                                  for word in WORDS]),
+        ("posts_get_body_like", ["/api/posts?body_like={}".format(word)
+                                 for word in WORDS]),
+        ("posts_get_title_and_body_like",
+         ["/api/posts?title_like={}&body_like={}".format(word, other)
+          for word, other in zip(WORDS, reversed(WORDS))]),
+        ("posts_get_search", ["/api/posts?q={}".format(word)
+                              for word in WORDS]),
+        ("post_get", ["/api/posts/{}".format(generator.randint(1, count))
+                      for _ in range(1000)])
+    ]
+    if stream:
+        scenarios.append(("posts_get_stream", ["/api/posts?stream=1"]))
+    return scenarios
+
+def test_client():
+    """ Client for 'run' which requests paths through the test client """
+    client = app.test_client()
+
+    def request(path):
+        response = client.get(path, headers=[("Accept", "application/json")])
+        # Read streamed responses to the end
+        response.data
+        return response.status_code < 500
+    return request
+
+def resident_kb(pid="self"):
+    """
+    Current resident memory of a process in kilobytes, read from /proc, or
+    None where it cannot be read
+    """
+    try:
+        with open("/proc/{}/statm".format(pid)) as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+def git_commit():
+    """ The commit being benchmarked, for comparing results later """
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(args):
+    if not args.url:
+        seed(args.posts)
+    client = http_client(args.url) if args.url else test_client
+
+    results = {
+        "commit": git_commit(),
+        "database": engine.dialect.name,
+        "posts": args.posts,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "scenarios": {}
+    }
+    for name, paths in scenarios(args.posts, args.stream):
+        if args.only and name not in args.only:
+            continue
+        result = run(client, paths, args.concurrency, args.duration)
+        # Resident memory of the server after the scenario, which is this
+        # process unless driving a server over HTTP
+        if not args.url:
+            result["rss_kb"] = resident_kb()
+        elif args.server_pid:
+            result["rss_kb"] = resident_kb(args.server_pid)
+        results["scenarios"][name] = result
+        print("{:<32}{:>10.1f} req/s  p50 {:>8.2f} ms  p95 {:>8.2f} ms  "
+              "p99 {:>8.2f} ms  {:>8} KB".format(
+                  name, result["requests_per_second"],
+                  (result["p50"] or 0) * 1000, (result["p95"] or 0) * 1000,
+                  (result["p99"] or 0) * 1000, result.get("rss_kb") or "-"))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+def compare(args):
+    """
+    Compare two result files, exiting with status 1 if any scenario lost
+    more than 'threshold' of its throughput or grew its p99 latency by more
+    than 'threshold'
+    """
+    with open(args.old) as old:
+        old = json.load(old)["scenarios"]
+    with open(args.new) as new:
+        new = json.load(new)["scenarios"]
+
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name], new[name]
+        throughput = (after["requests_per_second"] /
+                      (before["requests_per_second"] or 1.0)) - 1
+        p99 = ((after["p99"] or 0) / (before["p99"] or 1.0)) - 1
+        regressed = throughput < -args.threshold or p99 > args.threshold
+        print("{:<32}{:>+9.1%} req/s  {:>+9.1%} p99{}".format(
+            name, throughput, p99, "  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+    if regressions:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    commands = parser.add_subparsers()
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--posts", type=int, default=1000,
+                            help="Number of posts to seed")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--duration", type=float, default=5,
+                            help="Seconds to run each scenario for")
+    run_parser.add_argument("--stream", action="store_true",
+                            help="Include a full streamed export")
+    run_parser.add_argument("--only", nargs="+", help="Scenarios to run")
+    run_parser.add_argument("--url", help="Drive a running server instead")
+    run_parser.add_argument("--server-pid", type=int,
+                            help="Process id of the server at --url, to "
+                                 "record its memory")
+    run_parser.add_argument("--output", help="Write the results as JSON")
+    run_parser.set_defaults(command=run_benchmarks)
+
+    compare_parser = commands.add_parser("compare",
+                                         help="Compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    compare_parser.set_defaults(command=compare)
+
+    args = parser.parse_args()
+    args.command(args)
+
+if __name__ == "__main__":
+    main()
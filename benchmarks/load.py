@@ -0,0 +1,108 @@
+"""
+Helpers for driving an HTTP server with concurrent clients and
+summarizing the latencies they see
+"""
+import time
+import httplib
+import threading
+from urlparse import urlparse
+
+def percentile(values, fraction):
+    """ Get a percentile from a sorted list of values """
+    if not values:
+        return None
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+def summarize(latencies, errors, elapsed):
+    """ Throughput and latency percentiles for a run, in seconds """
+    latencies = sorted(latencies)
+    summary = {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99)
+    }
+    return summary
+
+def run(client, paths, concurrency, duration):
+    """
+    Request the paths in turn from 'concurrency' threads for 'duration'
+    seconds.  'client' is called once in each thread and returns a function
+    which makes one request for a path and returns whether it succeeded.
+    """
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    deadline = time.time() + duration
+
+    def worker(offset):
+        request = client()
+        count = offset
+        while time.time() < deadline:
+            path = paths[count % len(paths)]
+            count += 1
+            start = time.time()
+            ok = request(path)
+            latency = time.time() - start
+            with lock:
+                if ok:
+                    latencies.append(latency)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker, args=(offset,))
+               for offset in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.time() - start)
+
+def http_client(base_url, headers=None):
+    """
+    Client for 'run' which requests paths from a server over HTTP,
+    opening a new connection for each request
+    """
+    if headers is None:
+        headers = {"Accept": "application/json"}
+    url = urlparse(base_url)
+
+    def client():
+        def request(path):
+            try:
+                connection = httplib.HTTPConnection(url.hostname, url.port,
+                                                    timeout=60)
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                connection.close()
+                return response.status < 500
+            except (IOError, httplib.HTTPException):
+                return False
+        return request
+    return client
+
+def drive(base_url, paths, concurrency, duration, headers=None):
+    """ Drive a server over HTTP from concurrent clients """
+    return run(http_client(base_url, headers), paths, concurrency, duration)
+
+def wait_for_server(base_url, timeout=30):
+    """ Wait until a server accepts connections """
+    url = urlparse(base_url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = httplib.HTTPConnection(url.hostname, url.port,
+                                                timeout=1)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except (IOError, httplib.HTTPException):
+            time.sleep(0.1)
+    raise RuntimeError("Server at {} did not start".format(base_url))
@@ -0,0 +1,79 @@
+"""
+Compare the threaded WSGI development server started by run.py, the
+gevent server started by run_async.py and the pre-fork server started by
+run_prefork.py, under the same concurrent load.
+
+    python -m benchmarks.servers --concurrency 200 --duration 30
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+from benchmarks.load import drive, wait_for_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = [
+    ("wsgi", "run.py"),
+    ("async", "run_async.py"),
+    ("prefork", "run_prefork.py")
+]
+
+def server_env(port, args):
+    env = dict(os.environ, PORT=str(port))
+    if args.config:
+        env["CONFIG_PATH"] = args.config
+    return env
+
+def benchmark(script, port, args):
+    """ Start a server script, drive it, and stop it again """
+    env = server_env(port, args)
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, script)],
+                              env=env, cwd=ROOT)
+    try:
+        base_url = "http://127.0.0.1:{}".format(port)
+        wait_for_server(base_url)
+        return drive(base_url, args.paths, args.concurrency, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8090)
+    # The pre-fork server cannot share an in-process cache between workers
+    parser.add_argument("--config", default="posts.config.BenchmarkConfig",
+                        help="CONFIG_PATH for the servers")
+    parser.add_argument("--paths", nargs="+",
+                        default=["/api/posts", "/api/posts/1"])
+    parser.add_argument("--output", help="Write the results as JSON")
+    args = parser.parse_args()
+
+    # Servers no longer create the tables as they start
+    subprocess.check_call([sys.executable, os.path.join(ROOT, "run.py"),
+                           "migrate"], env=server_env(args.port, args),
+                          cwd=ROOT)
+
+    results = {}
+    for name, script in SERVERS:
+        results[name] = benchmark(script, args.port, args)
+
+    print("{:<8}{:>12}{:>10}{:>10}{:>10}".format(
+        "server", "req/s", "p50 ms", "p99 ms", "errors"))
+    for name, _ in SERVERS:
+        result = results[name]
+        print("{:<8}{:>12.1f}{:>10.1f}{:>10.1f}{:>10}".format(
+            name, result["requests_per_second"],
+            (result["p50"] or 0) * 1000, (result["p99"] or 0) * 1000,
+            result["errors"]))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,9 @@
 import os
+import time
+
+# Time taken to import the app, which a pre-fork server pays for every
+# worker it spawns
+started = time.time()
 
 from flask import Flask
 
@@ -6,8 +11,10 @@ app = Flask(__name__)
 config_path = os.environ.get("CONFIG_PATH", "posts.config.DevelopmentConfig")
 app.config.from_object(config_path)
 
+# Importing the app does not connect to the database: the engines connect
+# on first use, and the tables are created by 'python run.py migrate'
 import api
+import metrics
+import compression
 
-from database import Base, engine
-Base.metadata.create_all(engine)
-
+app.boot_seconds = time.time() - started
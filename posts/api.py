@@ -1,60 +1,324 @@
 import json
+import math
+import time
 
-from flask import request, Response, url_for
-from jsonschema import validate, ValidationError
+from flask import request, Response, url_for, g
+from werkzeug.urls import url_encode
+from sqlalchemy import func
 
+import cache
+import etags
 import models
 import decorators
+import search
+import serializers
+import pagination
+import streaming
+import writes
+import validation
+import writebehind
+import changes
 from posts import app
-from database import session
+from database import session, engine, use_replica, wrote_recently
 
-# JSON Schema describing the structure of a post
-post_schema = {
-    "properties": {
-        "title" : {"type" : "string"},
-        "body" : {"type": "string"}
-    },
-    "required" : ["title", "body"]
-}
+def filter_posts(posts, title_like, body_like, q):
+    """
+    Add the 'title_like' and 'body_like' filters and the full-text search
+    'q' to a query for posts, returning the query and the rank of each
+    match, or None if the posts are not ranked
+    """
+    # Add filter from 'title_like' query string
+    if title_like:
+        posts = posts.filter(models.Post.title.contains(title_like))
+    
+    # Add filter from 'body_like' query string
+    if body_like:
+        posts = posts.filter(models.Post.body.contains(body_like))
+    
+    # Add full-text search from 'q' query string
+    rank = None
+    if q:
+        posts, rank = search.search(posts, q, engine.dialect.name)
+    return posts, rank
 
 @app.route("/api/posts", methods=["GET"])
-@decorators.accept("application/json")
+@decorators.accept("application/json", streaming.NDJSON)
+@decorators.rate_limit()
+@decorators.concurrency_limit()
 def posts_get():
     """ Get a list of posts """
+    # Read from a replica when one is available
+    replica = use_replica()
+    
     # Get the query string arguments for title
     title_like = request.args.get("title_like")
     
     # Get the query string arguments for body
     body_like = request.args.get("body_like")
     
-    # Get the posts from the database
-    posts = session.query(models.Post)
+    # Get the query string arguments for a full-text search
+    q = request.args.get("q")
     
-    # Add filter from 'title_like' and 'body_like' query string
-    if title_like and body_like:
-        posts = posts.filter(models.Post.title.contains(title_like)).\
-                    filter(models.Post.body.contains(body_like))
+    # Get the fields to include for each post
+    # If any are unknown, return a 400 Bad Request
+    try:
+        fields = serializers.parse_fields(request.args.get("fields"),
+                                          app.config["POSTS_LIST_FIELDS"])
+    except ValueError as error:
+        data = json.dumps({"message": str(error)})
+        return Response(data, 400, mimetype="application/json")
     
-    # Add filter from 'title_like' query string
-    if title_like:
-        posts = posts.filter(models.Post.title.contains(title_like))
+    # Stream every matching post when asked for a full export, either with
+    # the 'stream' query string or by accepting NDJSON
+    ndjson = streaming.wants_ndjson(request.accept_mimetypes)
+    stream = ndjson or request.args.get("stream") in ("1", "true")
     
-    # Add filter from 'body_like' quert string
-    if body_like:
-        posts = posts.filter(models.Post.body.contains(body_like))
+    # Return the cached page for the same query string if there is one,
+    # unless the client has just written and may not see its write there
+    cache_key = url_encode(request.args, sort=True)
+    if not stream and not wrote_recently():
+        cached = cache.responses.get_page(cache_key)
+        if cached is not None:
+            data, headers, etag = cached
+            if etags.none_match(request.if_none_match, etag):
+                return etags.not_modified(etag)
+            return Response(data, 200, headers=headers,
+                            mimetype="application/json")
+    
+    # Get only the columns needed for the fields from the database, without
+    # building ORM objects for the posts
+    posts = session.query(*models.post_columns(
+        fields, app.config["POSTS_PREVIEW_LENGTH"]))
+    
+    # Add the filters and full-text search from the query string
+    posts, rank = filter_posts(posts, title_like, body_like, q)
+    
+    # Order by relevance when searching, then by id, so that pages can
+    # seek to the cursor instead of using OFFSET
+    keys = [(models.Post.id, False)]
+    if rank is not None:
+        keys.insert(0, (rank, True))
+    
+    # Get the page size and start after the cursor from the previous page
+    # If either is malformed, return a 400 Bad Request
+    try:
+        limit = pagination.get_limit(request.args.get("limit"))
+        after = pagination.decode_cursor(request.args.get("cursor"))
+        posts = pagination.seek(posts, keys, after)
+    except ValueError as error:
+        data = json.dumps({"message": str(error)})
+        return Response(data, 400, mimetype="application/json")
+    
+    if stream:
+        return streaming.stream_posts(posts, ndjson, fields)
+    
+    # Answer a conditional request from the ids and versions of the posts
+    # on the page, without loading or serializing the posts themselves
+    if request.if_none_match:
+        rows = posts.with_entities(models.Post.id, models.Post.version).\
+                   limit(limit + 1).all()
+        etag = etags.page_etag(cache_key, rows[:limit])
+        if etags.none_match(request.if_none_match, etag):
+            return etags.not_modified(etag)
+    
+    # Fetch one post more than the page size to find out whether there
+    # is a next page, along with the rank needed for the next cursor
+    if rank is not None:
+        posts = posts.add_columns(rank.label("rank"))
+    posts = posts.limit(limit + 1).all()
     
-    posts = posts.all()
+    headers = {}
+    last_id = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        last = posts[-1]
+        if rank is not None:
+            values = [last.rank, last.id]
+        else:
+            values = [last.id]
+        last_id = values[-1]
+        headers["Link"] = pagination.next_link("posts_get", values,
+                                               request.args)
     
-    # Convert the posts to JSON and return a response
-    data = json.dumps([post.as_dictionary() for post in posts])
+    # Tag the page with the versions of the posts on it
+    etag = etags.page_etag(cache_key, [(post.id, post.version)
+                                       for post in posts])
+    headers["ETag"] = etags.header(etag)
+    
+    # Join the JSON for each post, reusing the JSON for posts which have
+    # been served before, and cache it along with the range of ids the
+    # page covers, so that writes can find the pages they change.  Pages
+    # read from a replica may miss recent writes, so only pages read from
+    # the primary are cached.
+    data = serializers.encode_list(serializers.post_fragment(post, fields)
+                                   for post in posts)
+    if not replica:
+        after_id = int(after[-1]) if after is not None else None
+        cache.responses.set_page(cache_key, (data, headers, etag),
+                                 [post.id for post in posts],
+                                 after=after_id, last=last_id,
+                                 ranked=rank is not None)
+    return Response(data, 200, headers=headers, mimetype="application/json")
+
+@app.route("/api/posts/stats", methods=["GET"])
+@decorators.accept("application/json")
+@decorators.rate_limit()
+@decorators.concurrency_limit()
+def posts_stats_get():
+    """ Count the posts, and those matching any filters or search """
+    # Read from a replica when one is available
+    use_replica()
+    
+    # Get the totals from the summary table rather than counting the posts,
+    # adding up the slots each count is spread over
+    stats = models.post_stats.c
+    distributions = {}
+    for row in session.query(stats.field, stats.bucket,
+                             func.sum(stats.count).label("count")).\
+                   group_by(stats.field, stats.bucket).\
+                   order_by(stats.field, stats.bucket):
+        distributions.setdefault(row.field, []).append(
+            {"min": row.bucket, "count": row.count})
+    # Each bucket ends where the next one starts
+    for buckets in distributions.values():
+        for bucket, following in zip(buckets, buckets[1:] + [None]):
+            bucket["max"] = following["min"] - 1 if following else None
+    
+    data = {
+        "count": sum(bucket["count"]
+                     for bucket in distributions.get("title", [])),
+        "title_length": distributions.get("title", []),
+        "body_length": distributions.get("body", [])
+    }
+    
+    # Count the matches for the filters and search in the query string,
+    # which uses the full-text index when searching
+    title_like = request.args.get("title_like")
+    body_like = request.args.get("body_like")
+    q = request.args.get("q")
+    if title_like or body_like or q:
+        matches = session.query(func.count(models.Post.id)).\
+                      select_from(models.Post)
+        matches, rank = filter_posts(matches, title_like, body_like, q)
+        data["matches"] = matches.scalar()
+    
+    return Response(json.dumps(data), 200, mimetype="application/json")
+
+@app.route("/api/posts/changes", methods=["GET"])
+@decorators.accept("application/json")
+@decorators.rate_limit()
+@decorators.concurrency_limit()
+def posts_changes_get():
+    """
+    Changes to posts after the sequence number 'since', waiting up to
+    'wait' seconds for one to be made if there are none yet
+    """
+    # Get the sequence number and time to wait
+    # If either is malformed, return a 400 Bad Request
+    try:
+        since = int(request.args.get("since", 0))
+        wait = float(request.args.get("wait", 0))
+        # A wait of nan would never end, and one of inf would hold a
+        # worker for the longest wait allowed
+        if math.isnan(wait) or math.isinf(wait) or wait < 0:
+            raise ValueError(wait)
+    except ValueError:
+        data = json.dumps({"message": "since and wait must be numbers"})
+        return Response(data, 400, mimetype="application/json")
+    wait = min(wait, app.config["CHANGES_MAX_WAIT"])
+    
+    # Get the page size
+    # If it is malformed, return a 400 Bad Request
+    try:
+        limit = pagination.get_limit(request.args.get("limit"),
+                                     "CHANGES_PER_PAGE", "CHANGES_MAX_PER_PAGE")
+    except ValueError as error:
+        data = json.dumps({"message": str(error)})
+        return Response(data, 400, mimetype="application/json")
+    
+    # Check that no changes the client has not seen have been compacted
+    # If some have, return a 410 Gone so that it syncs in full
+    compacted = changes.compacted_seq(session.connection())
+    if since < compacted:
+        message = "Changes up to {} have been compacted".format(compacted)
+        data = json.dumps({"message": message})
+        return Response(data, 410, mimetype="application/json")
+    
+    # Poll for changes until there are some or the wait is over, giving
+    # the connection back to the pool between polls
+    deadline = time.time() + wait
+    while True:
+        rows = changes.read_changes(session.connection(), since, limit)
+        if rows or time.time() >= deadline:
+            break
+        session.close()
+        time.sleep(min(app.config["CHANGES_POLL_INTERVAL"],
+                       max(deadline - time.time(), 0)))
+    
+    # Creates and updates carry the post as of the version they made,
+    # unless a later change has replaced it, and deletes are tombstones
+    # with only the id
+    entries = []
+    for row in rows:
+        entry = {"seq": row.seq, "op": row.op, "id": row.post_id,
+                 "version": row.version}
+        if row.title is not None or row.body is not None:
+            entry["post"] = {"id": row.post_id, "title": row.title,
+                             "body": row.body}
+        entries.append(entry)
+    
+    # The client continues from the last change it was sent
+    next_since = rows[-1].seq if rows else since
+    data = serializers.dumps({"changes": entries, "since": next_since})
     return Response(data, 200, mimetype="application/json")
 
 @app.route("/api/posts/<int:id>", methods=["GET"])
 @decorators.accept("application/json")
+@decorators.rate_limit()
+@decorators.concurrency_limit()
 def post_get(id):
     """ Single post """   
-    # Get the post from the database
-    post = session.query(models.Post).get(id)
+    # Read from a replica when one is available
+    replica = use_replica()
+    
+    # Get the fields to include
+    # If any are unknown, return a 400 Bad Request
+    try:
+        fields = serializers.parse_fields(request.args.get("fields"))
+    except ValueError as error:
+        data = json.dumps({"message": str(error)})
+        return Response(data, 400, mimetype="application/json")
+    
+    # Only the full representation is cached, as other fields are quick to
+    # build from the cached fragments
+    full = fields == serializers.DEFAULT_FIELDS
+    tag_fields = None if full else fields
+    
+    # Return the cached post if there is one, unless the client has just
+    # written and may not see its write there
+    cached = None
+    if full and not wrote_recently():
+        cached = cache.responses.get_post(id)
+    if cached is not None:
+        data, etag = cached
+        if etags.none_match(request.if_none_match, etag):
+            return etags.not_modified(etag)
+        headers = {"ETag": etags.header(etag)}
+        return Response(data, 200, headers=headers, mimetype="application/json")
+    
+    # Answer a conditional request by looking up only the post's version
+    if request.if_none_match:
+        version = session.query(models.Post.version).\
+                      filter(models.Post.id == id).scalar()
+        if version is not None:
+            etag = etags.post_etag(id, version, tag_fields)
+            if etags.none_match(request.if_none_match, etag):
+                return etags.not_modified(etag)
+    
+    # Get only the columns needed for the fields from the database
+    post = session.query(*models.post_columns(
+               fields, app.config["POSTS_PREVIEW_LENGTH"])).\
+               filter(models.Post.id == id).first()
     
     # Check whether the post exists
     # If no, return a 404 with a helpful message
@@ -64,78 +328,250 @@ def post_get(id):
         return Response(data, 404, mimetype="application/json")
     
     # If yes, return the post as JSON
-    data = json.dumps(post.as_dictionary())
-    return Response(data, 200, mimetype="application/json")
+    data = serializers.post_fragment(post, fields)
+    etag = etags.post_etag(id, post.version, tag_fields)
+    # Posts read from a replica may miss recent writes, so are not cached
+    if full and not replica:
+        cache.responses.set_post(id, (data, etag))
+    headers = {"ETag": etags.header(etag)}
+    return Response(data, 200, headers=headers, mimetype="application/json")
 
 @app.route("/api/posts/<int:id>", methods=["DELETE"])
 @decorators.accept("application/json")
+@decorators.rate_limit()
+@decorators.concurrency_limit()
 def post_delete(id):
     """ Delete single post """    
-    # Get the post from the database
-    post = session.query(models.Post).get(id)
-    
-    # Check whether the post exists
-    # If no, return a 404 with a helpful message
-    if not post:
-        message = "Could not find post with id {}".format(id)
-        data = json.dumps({"message": message})
-        return Response(data, 404, mimetype="application/json")
-    
-    # If yes, delete the post from database with confirmation message
-    session.delete(post)
+    # Delete the post in one statement, provided the client has the current
+    # version if it sent If-Match
+    connection = session.connection()
+    versions = if_match_versions(id)
+    if not writes.delete_post(connection, id, versions):
+        response = write_failed(connection, id, versions)
+        session.rollback()
+        return response
     session.commit()
+    cache.responses.invalidate(deleted=[id])
+    
+    # If it was deleted, return a confirmation message
     message = "Deleted post with id {} from database".format(id)
     data = json.dumps({"message": message})
     return Response(data, 200, mimetype="application/json")
 
+def if_match_versions(id):
+    """
+    Get the versions of a post which the If-Match header allows a write
+    to, or None if any version is allowed.  The tags are compared strongly,
+    so weak tags never match.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    versions = [etags.post_version(tag, id)
+                for tag in request.if_match.as_set()]
+    return [version for version in versions if version is not None]
+
+def write_failed(connection, id, versions):
+    """
+    Explain why a write to a post changed nothing: a 404 if the post does
+    not exist, or a 412 Precondition Failed if it has another version than
+    the client expected
+    """
+    if versions is not None and writes.existing_ids(connection, [id]):
+        message = "Post with id {} has been modified".format(id)
+        data = json.dumps({"message": message})
+        return Response(data, 412, mimetype="application/json")
+    message = "Could not find post with id {}".format(id)
+    data = json.dumps({"message": message})
+    return Response(data, 404, mimetype="application/json")
+
 @app.route("/api/posts", methods=["POST"])
 @decorators.accept("application/json")
+@decorators.rate_limit()
 @decorators.require("application/json")
+@decorators.json_body(validation.post_validator, "POSTS_MAX_BODY_SIZE")
+@decorators.concurrency_limit()
 def post_post():
     """ Add a new post """
-    # To access the data passed into the endpoint
-    data = request.json
+    # To access the data passed into the endpoint, which has been checked
+    # against the post schema
+    data = g.data
     
-    # Check that the JSON supplied is valid
-    # If not, return a 422 Unprocessable Entity
-    try:
-        validate(data, post_schema)
-    except ValidationError as error:
-        data = {"message": error.message}
-        return Response(json.dumps(data), 422, mimetype="application/json")    
-    
-    # Add the post to the database
-    post = models.Post(title=data["title"], body=data["body"])
-    session.add(post)
+    # Queue the post to be written in the background if write-behind is on
+    if writebehind.writer is not None:
+        return queue_post(data)
+    
+    # Add the post to the database, which returns its id
+    id = writes.create_post(session.connection(), data["title"], data["body"])
     session.commit()
+    cache.responses.invalidate(created=[id])
     
     # Return a 201 Created, containing the post as JSON and with the
     # Location header set to the location of the post
-    data = json.dumps(post.as_dictionary())
-    headers = {"Location": url_for("post_get", id=post.id)}
+    post = models.Post(id=id, title=data["title"], body=data["body"],
+                       version=writes.FIRST_VERSION)
+    data = serializers.encode_post(post)
+    headers = {"Location": url_for("post_get", id=id),
+               "ETag": etags.header(etags.post_etag(id, post.version))}
     return Response(data, 201, headers=headers, mimetype="application/json")
 
+def queue_post(data):
+    """
+    Queue a post to be written, returning a 202 Accepted with the location
+    of its status, or a 503 Service Unavailable if the queue is full
+    """
+    try:
+        ticket = writebehind.writer.put(data)
+    except writebehind.QueueFull:
+        message = "Too many posts are waiting to be written"
+        data = json.dumps({"message": message})
+        headers = {"Retry-After": str(app.config["WRITE_BEHIND_RETRY_AFTER"])}
+        return Response(data, 503, headers=headers,
+                        mimetype="application/json")
+    
+    data = json.dumps({"ticket": ticket, "status": "queued"})
+    headers = {"Location": url_for("queued_post_get", ticket=ticket)}
+    return Response(data, 202, headers=headers, mimetype="application/json")
+
+@app.route("/api/posts/queued/<ticket>", methods=["GET"])
+@decorators.accept("application/json")
+@decorators.rate_limit()
+def queued_post_get(ticket):
+    """ Whether a queued post has been written yet """
+    status = None
+    if writebehind.writer is not None:
+        status = writebehind.writer.queue.status(ticket)
+    
+    # Check whether the ticket is known
+    # If not, return a 404 with a helpful message
+    if status is None:
+        message = "Could not find queued post {}".format(ticket)
+        data = json.dumps({"message": message})
+        return Response(data, 404, mimetype="application/json")
+    
+    # Once the post is written, point to it
+    state, id = status
+    data = {"ticket": ticket, "status": state}
+    headers = {}
+    if id is not None:
+        data["id"] = id
+        headers["Location"] = url_for("post_get", id=id)
+    return Response(json.dumps(data), 200, headers=headers,
+                    mimetype="application/json")
+
 @app.route("/api/posts/<int:id>", methods=["PUT"])
 @decorators.accept("application/json")
+@decorators.rate_limit()
 @decorators.require("application/json")
+@decorators.json_body(validation.post_validator, "POSTS_MAX_BODY_SIZE")
+@decorators.concurrency_limit()
 def post_edit(id):
     """ Edit a post """
-    # To access the data passed into the endpoint
-    data = request.json
+    # To access the data passed into the endpoint, which has been checked
+    # against the post schema
+    data = g.data
     
-    # Get the post from the database
-    post = session.query(models.Post).get(id)
+    # Update the post in one statement, provided the client has the
+    # current version if it sent If-Match
+    connection = session.connection()
+    versions = if_match_versions(id)
+    version = writes.update_post(connection, id, data["title"], data["body"],
+                                 versions)
+    if version is None:
+        response = write_failed(connection, id, versions)
+        session.rollback()
+        return response
+    session.commit()
+    cache.responses.invalidate(updated=[id])
     
-    # Check whether the post exists
-    # If no, return a 404 with a helpful message
-    if not post:
-        message = "Could not find post with id {}".format(id)
-        data = json.dumps({"message": message})
-        return Response(data, 404, mimetype="application/json")
+    # Return the edited post as JSON, tagged with its new version
+    post = models.Post(id=id, title=data["title"], body=data["body"],
+                       version=version)
+    data = serializers.encode_post(post)
+    headers = {"ETag": etags.header(etags.post_etag(id, version))}
+    return Response(data, 200, headers=headers, mimetype="application/json")
 
-    # If yes, gives ability to edit the post
-    post.title = data["title"]
-    post.body = data["body"]
-    session.add(post)
+@app.route("/api/posts/batch", methods=["POST"])
+@decorators.accept("application/json")
+@decorators.rate_limit()
+@decorators.require("application/json")
+@decorators.json_body(validation.batch_validator, "POSTS_MAX_BATCH_BODY_SIZE")
+@decorators.concurrency_limit()
+def posts_batch():
+    """ Create, update and delete many posts in one transaction """
+    # To access the data passed into the endpoint, which has been checked
+    # to be a list of operations
+    data = g.data
+    
+    # Check that the batch is not larger than the server allows
+    # If it is, return a 413 Request Entity Too Large
+    if len(data) > app.config["POSTS_MAX_BATCH"]:
+        message = "Batch must contain at most {} operations".format(
+            app.config["POSTS_MAX_BATCH"])
+        data = json.dumps({"message": message})
+        return Response(data, 413, mimetype="application/json")
+    
+    # Check every operation in one pass, and reject the whole batch with
+    # a 422 Unprocessable Entity listing the invalid operations
+    errors = []
+    for index, operation in enumerate(data):
+        message = validation.first_error(
+            validation.batch_operation_validators[operation["op"]], operation)
+        if message is not None:
+            errors.append({"index": index, "message": message})
+    if errors:
+        data = {"message": "Batch contains invalid operations",
+                "errors": errors}
+        return Response(json.dumps(data), 422, mimetype="application/json")
+    
+    connection = session.connection()
+    
+    # Find out which of the posts to update or delete exist, so that the
+    # results for missing posts can be reported without a query per post
+    existing = writes.existing_ids(connection, [operation["id"]
+                                                for operation in data
+                                                if "id" in operation])
+    
+    # Work out the result of each operation in order, grouping the changes
+    # so that each kind of statement is run in bulk
+    results = []
+    creates = []
+    updates = {}
+    deletes = []
+    for operation in data:
+        op = operation["op"]
+        result = {"op": op}
+        if op == "create":
+            creates.append({"title": operation["title"],
+                            "body": operation["body"]})
+            result["status"] = 201
+        elif operation["id"] not in existing:
+            message = "Could not find post with id {}".format(operation["id"])
+            result.update(id=operation["id"], status=404, message=message)
+        elif op == "update":
+            updates[operation["id"]] = {"id": operation["id"],
+                                        "title": operation["title"],
+                                        "body": operation["body"]}
+            result.update(id=operation["id"], status=200)
+        else:
+            # Later operations in the batch no longer see a deleted post
+            existing.discard(operation["id"])
+            updates.pop(operation["id"], None)
+            deletes.append(operation["id"])
+            result.update(id=operation["id"], status=200)
+        results.append(result)
+    
+    # Apply the changes in a single transaction
+    ids = writes.create_posts(connection, creates)
+    writes.update_posts(connection, list(updates.values()))
+    writes.delete_posts(connection, deletes)
     session.commit()
-    return Response(data, 200, mimetype="application/json")
\ No newline at end of file
+    cache.responses.invalidate(created=ids, updated=list(updates.keys()),
+                               deleted=deletes)
+    
+    # Fill in the ids of the created posts
+    ids = iter(ids)
+    for result in results:
+        if result["op"] == "create":
+            result["id"] = next(ids)
+    
+    return Response(json.dumps(results), 200, mimetype="application/json")
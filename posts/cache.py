@@ -0,0 +1,272 @@
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from posts import app
+
+class Cache(object):
+    """
+    Base class for cache backends, which counts hits, misses and evictions.
+    Subclasses store the values by implementing the underscored methods.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Get the value stored under a key, or None on a miss """
+        value = self._get(key)
+        self.count(value is not None)
+        return value
+
+    def count(self, hit):
+        """ Count a lookup as a hit or a miss """
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def peek(self, key):
+        """ Get the value stored under a key without counting a hit or miss """
+        return self._get(key)
+
+    def set(self, key, value):
+        self._set(key, value)
+
+    def delete(self, key):
+        self._delete(key)
+
+    def clear(self):
+        self._clear()
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+        return stats
+
+class LRUCache(Cache):
+    """
+    In-process cache holding at most 'max_size' values, each for at most
+    'ttl' seconds, which evicts the least recently used value when full
+    """
+    def __init__(self, max_size, ttl):
+        Cache.__init__(self)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.values = OrderedDict()
+
+    def _get(self, key):
+        with self.lock:
+            try:
+                expires, value = self.values.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            # Move the value to the most recently used end
+            self.values[key] = (expires, value)
+            return value
+
+    def _set(self, key, value):
+        with self.lock:
+            self.values.pop(key, None)
+            self.values[key] = (time.time() + self.ttl, value)
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+                self.evictions += 1
+
+    def _delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def _clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def stats(self):
+        stats = Cache.stats(self)
+        stats["size"] = len(self.values)
+        return stats
+
+class NullCache(Cache):
+    """ Cache which stores nothing, for running without a cache """
+    def _get(self, key):
+        return None
+
+    def _set(self, key, value):
+        pass
+
+    def _delete(self, key):
+        pass
+
+    def _clear(self):
+        pass
+
+class RedisCache(Cache):
+    """
+    Cache shared between processes through Redis, or through any client
+    object with the same get, setex, delete and scan_iter methods
+    """
+    def __init__(self, ttl, url=None, client=None, prefix="posts:"):
+        Cache.__init__(self)
+        if client is None:
+            if redis is None:
+                raise RuntimeError("The redis package is required for "
+                                   "the redis cache backend")
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def _set(self, key, value):
+        self.client.setex(self.prefix + key, self.ttl,
+                          pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def _delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def _clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+class ResponseCache(object):
+    """
+    Cache of serialized responses for single posts and pages of posts.
+
+    Pages are indexed by the range of ids they cover so that a write only
+    invalidates the pages it can change.  The index is held in this
+    process, so a backend shared between processes relies on its TTL to
+    expire pages changed by writes made elsewhere.
+
+    The JSON for individual posts, used to build pages, is kept in a
+    separate in-process cache of fragments.
+    """
+    def __init__(self, backend, max_pages, fragments):
+        self.backend = backend
+        self.max_pages = max_pages
+        self.fragments = fragments
+        self.lock = threading.Lock()
+        self.pages = OrderedDict()
+
+    def get_post(self, id):
+        return self.backend.get("post:{}".format(id))
+
+    def set_post(self, id, value):
+        self.backend.set("post:{}".format(id), value)
+
+    def get_fragment(self, id, version, fields):
+        """ Get the JSON for some fields of a version of a post, or None """
+        cached = self.fragments.peek(id)
+        fragment = None
+        if cached is not None and cached[0] == version:
+            fragment = cached[1].get(fields)
+        self.fragments.count(fragment is not None)
+        return fragment
+
+    def set_fragment(self, id, version, fields, fragment):
+        # Only lookups by get_fragment count as hits or misses
+        cached = self.fragments.peek(id)
+        if cached is None or cached[0] != version:
+            cached = (version, {})
+            self.fragments.set(id, cached)
+        cached[1][fields] = fragment
+
+    def get_page(self, key):
+        return self.backend.get("page:" + key)
+
+    def set_page(self, key, value, ids, after=None, last=None, ranked=False):
+        """
+        Store a page of posts containing 'ids', which starts after the id
+        'after' and, if there is a next page, ends at the id 'last'.
+        Ranked pages are not ordered by id, so any write invalidates them.
+        """
+        with self.lock:
+            self.pages.pop(key, None)
+            self.pages[key] = (set(ids), after, last, ranked)
+            # Keep the index bounded, dropping the pages it forgets about
+            while len(self.pages) > self.max_pages:
+                old_key, _ = self.pages.popitem(last=False)
+                self.backend.delete("page:" + old_key)
+        self.backend.set("page:" + key, value)
+
+    def invalidate(self, created=(), updated=(), deleted=()):
+        """
+        Invalidate the entries which writes to posts can change.  A created
+        post appears on the last page of a listing, an updated post can
+        start or stop matching a filter on any page covering its id, and a
+        deleted post leaves the pages which contain it.
+        """
+        for id in list(updated) + list(deleted):
+            self.backend.delete("post:{}".format(id))
+            # Ids can be reused once deleted, so drop every version
+            self.fragments.delete(id)
+        deleted = set(deleted)
+
+        def affected(ids, after, last, ranked):
+            if ranked or (created and last is None) or ids & deleted:
+                return True
+            for id in updated:
+                if ((after is None or after < id) and
+                    (last is None or id <= last)):
+                    return True
+            return False
+
+        with self.lock:
+            keys = [key for key, page in self.pages.items() if affected(*page)]
+            for key in keys:
+                del self.pages[key]
+        for key in keys:
+            self.backend.delete("page:" + key)
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+        self.backend.clear()
+        self.fragments.clear()
+
+    def stats(self):
+        stats = self.backend.stats()
+        stats["pages"] = len(self.pages)
+        for name, value in self.fragments.stats().items():
+            stats["fragment_" + name] = value
+        return stats
+
+def make_cache(config):
+    """ Create the response cache for the backend named in the config """
+    backend = config["CACHE_BACKEND"]
+    if backend is None:
+        backend = NullCache()
+    elif backend == "redis":
+        backend = RedisCache(config["CACHE_TTL"], url=config["CACHE_REDIS_URL"])
+    elif backend == "lru":
+        backend = LRUCache(config["CACHE_MAX_SIZE"], config["CACHE_TTL"])
+    else:
+        raise ValueError("Unknown cache backend {}".format(backend))
+    # Fragments are stored by id and checked against the version, so they
+    # never need to expire.  They are only kept when caching is enabled.
+    if config["CACHE_BACKEND"] is None:
+        fragments = NullCache()
+    else:
+        fragments = LRUCache(config["FRAGMENT_CACHE_SIZE"], float("inf"))
+    return ResponseCache(backend, config["CACHE_MAX_SIZE"], fragments)
+
+responses = make_cache(app.config)
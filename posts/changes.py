@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, and_, func
+
+import models
+from posts import app
+from database import engine
+
+changes = models.post_changes
+posts = models.Post.__table__
+
+def read_changes(connection, since, limit):
+    """
+    Get up to 'limit' changes made after the sequence number 'since', in
+    order.  A create or update which made the current version of a post
+    comes with its title and body; older ones have been superseded by a
+    later change, and come without.
+    """
+    current = and_(posts.c.id == changes.c.post_id,
+                   posts.c.version == changes.c.version,
+                   changes.c.op != "delete")
+    query = select([changes.c.seq, changes.c.op, changes.c.post_id,
+                    changes.c.version, posts.c.title, posts.c.body]).\
+                select_from(changes.outerjoin(posts, current)).\
+                where(changes.c.seq > since).\
+                where(changes.c.op != "compacted").\
+                order_by(changes.c.seq).\
+                limit(limit)
+    return connection.execute(query).fetchall()
+
+def compacted_seq(connection):
+    """
+    The sequence number up to which changes have been removed, or 0 if
+    none have.  Clients which last synced before it must sync in full.
+    """
+    row = connection.execute(select([changes.c.seq, changes.c.op]).
+                             order_by(changes.c.seq).limit(1)).first()
+    if row is None or row.op != "compacted":
+        return 0
+    return row.seq
+
+def compact(connection, before):
+    """
+    Remove the changes made before the datetime 'before', keeping the
+    latest of them as a "compacted" marker.  Returns the number of changes
+    removed.
+    """
+    last = connection.execute(select([func.max(changes.c.seq)]).
+                              where(changes.c.changed < before)).scalar()
+    if last is None:
+        return 0
+    removed = connection.execute(changes.delete().
+                                 where(changes.c.seq < last)).rowcount
+    connection.execute(changes.update().where(changes.c.seq == last).
+                       values(op="compacted"))
+    return removed
+
+def compact_expired():
+    """ Remove the changes older than CHANGES_RETENTION seconds """
+    before = datetime.utcnow() - timedelta(
+        seconds=app.config["CHANGES_RETENTION"])
+    with engine.begin() as connection:
+        return compact(connection, before)
@@ -0,0 +1,119 @@
+import zlib
+import hashlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import request
+
+import cache
+import etags
+import streaming
+from posts import app
+
+# Mimetypes of the responses which are compressed
+COMPRESSED_MIMETYPES = ("application/json", streaming.NDJSON)
+
+def available_encodings():
+    """ Content codings this server can produce, best first """
+    if brotli is not None:
+        return ["br", "gzip"]
+    return ["gzip"]
+
+def choose_encoding(accept_encodings):
+    """ Pick the best content coding the client accepts, or None """
+    for encoding in available_encodings():
+        if accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+def compress(data, encoding):
+    """ Compress a whole response body """
+    if encoding == "br":
+        return brotli.compress(
+            data, quality=app.config["COMPRESSION_BROTLI_QUALITY"])
+    compressor = zlib.compressobj(app.config["COMPRESSION_GZIP_LEVEL"],
+                                  zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def compress_stream(chunks, encoding):
+    """
+    Compress a streamed response body, flushing after each chunk so that
+    the client receives the posts as soon as they are fetched
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor(
+            quality=app.config["COMPRESSION_BROTLI_QUALITY"])
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(app.config["COMPRESSION_GZIP_LEVEL"],
+                                      zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + \
+                  compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+# Compressed bodies, by encoding and a digest of the uncompressed body, so
+# that a hot page or post is compressed once rather than for every
+# request.  Keying on the content rather than the entity tag means a post
+# created with the id of a deleted one never gets the deleted one's bytes.
+compressed = cache.LRUCache(app.config["COMPRESSION_CACHE_SIZE"], float("inf"))
+
+def encode_not_modified(response):
+    """
+    Give a 304 Not Modified the tag and Vary header of the 200 it stands
+    for: the tag compressed for the client's encoding when that is the tag
+    the client holds
+    """
+    etag, weak = response.get_etag()
+    if etag is None:
+        return response
+    response.vary.add("Accept-Encoding")
+
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is not None:
+        encoded = etags.encoded_etag(etag, encoding)
+        if request.if_none_match.contains_weak(encoded):
+            response.set_etag(encoded, weak=weak)
+    return response
+
+@app.after_request
+def compress_response(response):
+    if (app.config["COMPRESSION_ENABLED"] and
+        response.status_code == 304):
+        return encode_not_modified(response)
+    if (not app.config["COMPRESSION_ENABLED"] or
+        response.mimetype not in COMPRESSED_MIMETYPES or
+        response.status_code != 200 or
+        "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config["COMPRESSION_MIN_SIZE"]:
+            return response
+        key = "{}:{}".format(encoding, hashlib.sha1(data).hexdigest())
+        body = compressed.get(key)
+        if body is None:
+            body = compress(data, encoding)
+            compressed.set(key, body)
+        response.set_data(body)
+    # The compressed bytes differ from the uncompressed ones, so they get a
+    # strong tag of their own
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etags.encoded_etag(etag, encoding), weak=weak)
+    response.headers["Content-Encoding"] = encoding
+    return response
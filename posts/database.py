@@ -1,10 +1,286 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import time
+import itertools
+import threading
+
+from flask import request
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session as BaseSession, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, NullPool
 from sqlalchemy.ext.declarative import declarative_base
 
 from posts import app
 
-engine = create_engine(app.config["DATABASE_URI"])
+class PoolMetrics(object):
+    """ Counters describing how connections move in and out of a pool """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checked_out = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def wait(self, seconds):
+        with self.lock:
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def checkout(self):
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+
+    def checkin(self):
+        with self.lock:
+            self.checked_out -= 1
+
+    def as_dictionary(self):
+        with self.lock:
+            metrics = {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checked_out": self.checked_out,
+                "wait_seconds": self.wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds
+            }
+        return metrics
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool which records how long each checkout waited for a free
+    connection
+    """
+    def __init__(self, *args, **kwargs):
+        self.metrics = PoolMetrics()
+        QueuePool.__init__(self, *args, **kwargs)
+
+    def _do_get(self):
+        start = time.time()
+        connection = QueuePool._do_get(self)
+        self.metrics.wait(time.time() - start)
+        return connection
+
+    def recreate(self):
+        # Keep counting into the same metrics when the engine is disposed
+        pool = QueuePool.recreate(self)
+        pool.metrics = self.metrics
+        return pool
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Check that a pooled connection is still alive before handing it out,
+    so the pool replaces connections the database has dropped
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        # The pool discards the connection and retries the checkout
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+def make_engine(uri):
+    """ Create an engine with the pool settings from the configuration """
+    url = make_url(uri)
+    options = {}
+    # SQLite uses its own pools, which do not take these settings
+    if url.get_dialect().get_pool_class(url) is QueuePool:
+        options = {
+            "poolclass": InstrumentedQueuePool,
+            "pool_size": app.config["DATABASE_POOL_SIZE"],
+            "max_overflow": app.config["DATABASE_MAX_OVERFLOW"],
+            "pool_timeout": app.config["DATABASE_POOL_TIMEOUT"],
+            "pool_recycle": app.config["DATABASE_POOL_RECYCLE"]
+        }
+    engine = create_engine(url, **options)
+
+    metrics = getattr(engine.pool, "metrics", None) or PoolMetrics()
+    engine.pool.metrics = metrics
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        with metrics.lock:
+            metrics.connects += 1
+
+    if app.config["DATABASE_POOL_PRE_PING"]:
+        event.listen(engine, "checkout", ping_connection)
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.checkout()
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        metrics.checkin()
+
+    return engine
+
+def make_probe(url, timeout):
+    """
+    Create an engine for health checks, which opens a connection of its own
+    for each check rather than waiting for one from the pool, and gives up
+    on a database which does not answer within 'timeout' seconds
+    """
+    url = make_url(url)
+    dialect = url.get_dialect().name
+    connect_args = {}
+    if dialect == "postgresql":
+        # libpq waits at least two seconds to connect
+        connect_args = {
+            "connect_timeout": max(int(timeout), 2),
+            "options": "-c statement_timeout={}".format(int(timeout * 1000))
+        }
+    elif dialect == "mysql":
+        connect_args = {"connect_timeout": max(int(timeout), 1)}
+    return create_engine(url, poolclass=NullPool, connect_args=connect_args)
+
+def is_healthy(engine):
+    """ Check whether a database answers a SELECT 1 """
+    try:
+        connection = engine.connect()
+        try:
+            connection.execute("SELECT 1")
+        finally:
+            connection.close()
+    except exc.SQLAlchemyError:
+        return False
+    return True
+
+class ReplicaSet(object):
+    """
+    Read replicas which take turns serving reads, either in order
+    ("round_robin") or by whichever has the fewest connections checked
+    out ("least_connections").  Each replica is checked at most once every
+    'check_interval' seconds, in a thread of its own so that no request
+    waits for a replica which does not answer, and replicas which fail are
+    skipped until they pass a later check.  A check gives up after
+    'check_timeout' seconds.
+    """
+    def __init__(self, engines, strategy="round_robin", check_interval=5,
+                 check_timeout=2):
+        if strategy not in ("round_robin", "least_connections"):
+            raise ValueError("Unknown replica strategy {}".format(strategy))
+        self.engines = list(engines)
+        self.strategy = strategy
+        self.check_interval = check_interval
+        self.probes = dict((engine, make_probe(engine.url, check_timeout))
+                           for engine in self.engines)
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.healthy = dict((engine, True) for engine in self.engines)
+        self.next_check = 0
+
+    def check(self):
+        """ Check the health of every replica now """
+        for engine in self.engines:
+            self.healthy[engine] = is_healthy(self.probes[engine])
+
+    def choose(self):
+        """ Get the engine to read from, or None if no replica is healthy """
+        if not self.engines:
+            return None
+        # Only the first thread past the interval starts the checks, and
+        # reads carry on with the replicas which passed the last ones
+        with self.lock:
+            due = time.time() >= self.next_check
+            if due:
+                self.next_check = time.time() + self.check_interval
+        if due:
+            checker = threading.Thread(target=self.check)
+            checker.daemon = True
+            checker.start()
+
+        engines = [engine for engine in self.engines if self.healthy[engine]]
+        if not engines:
+            return None
+        if self.strategy == "least_connections":
+            return min(engines,
+                       key=lambda engine: engine.pool.metrics.checked_out)
+        return engines[next(self.counter) % len(engines)]
+
+class RoutingSession(BaseSession):
+    """
+    Session which reads from its 'replica' engine when one has been chosen
+    for it, and otherwise uses the primary
+    """
+    replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        # Anything flushed is a write, which always goes to the primary
+        if self.replica is not None and not self._flushing:
+            return self.replica
+        return BaseSession.get_bind(self, mapper, clause)
+
+engine = make_engine(app.config["DATABASE_URI"])
+replicas = ReplicaSet([make_engine(uri)
+                       for uri in app.config["DATABASE_REPLICA_URIS"]],
+                      app.config["DATABASE_REPLICA_STRATEGY"],
+                      app.config["DATABASE_REPLICA_CHECK_INTERVAL"],
+                      app.config["DATABASE_REPLICA_CHECK_TIMEOUT"])
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
-session = Session()
+Session = sessionmaker(bind=engine, class_=RoutingSession)
+
+# Each thread gets its own session, which is discarded at the end of
+# every request so that a failed transaction cannot leak into the next one
+session = scoped_session(Session)
+
+def dispose_engines():
+    """
+    Give the primary and the replicas new, empty connection pools.  A
+    forked worker calls this so that it never uses a connection opened by
+    its parent; the parent must not have connected for the old pools to be
+    safe to drop.
+    """
+    engine.dispose()
+    for replica in replicas.engines:
+        replica.dispose()
+
+def migrate():
+    """
+    Create any missing tables and indexes on the primary database.  This
+    is run once per deployment rather than by every worker as it starts.
+    """
+    import models
+    Base.metadata.create_all(engine)
+
+# Cookie holding the time of a client's last write, so that its reads stay
+# on the primary until the replicas have caught up with it
+LAST_WRITE_COOKIE = "posts_last_write"
+
+def wrote_recently():
+    """
+    Whether the client wrote within the last DATABASE_READ_YOUR_WRITES
+    seconds, so that its reads must see the primary
+    """
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+    except ValueError:
+        last_write = 0
+    return time.time() - last_write < app.config["DATABASE_READ_YOUR_WRITES"]
+
+def use_replica():
+    """
+    Send the reads made by the current request's session to a replica,
+    unless the client wrote recently or no replica is healthy.  Returns
+    whether a replica was chosen, in which case the response may lag the
+    primary and must not be cached.
+    """
+    if wrote_recently():
+        return False
+    session().replica = replicas.choose()
+    return session().replica is not None
+
+@app.after_request
+def remember_write(response):
+    # Only requests which can change posts start a read-your-writes window
+    if (replicas.engines and response.status_code < 400 and
+        request.method not in ("GET", "HEAD", "OPTIONS")):
+        response.set_cookie(LAST_WRITE_COOKIE, "{:.3f}".format(time.time()),
+                            max_age=app.config["DATABASE_READ_YOUR_WRITES"])
+    return response
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    session.remove()
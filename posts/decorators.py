@@ -1,22 +1,28 @@
 import json
+import math
 from functools import wraps
 
-from flask import request, Response
+from flask import request, Response, current_app, g
 
-def accept(mimetype):
+import limits
+import validation
+
+def accept(*mimetypes):
     def decorator(func):
         """
         Decorator which returns a 406 Not Acceptable if the client
-        will not accept a certain mimetype
+        will not accept any of the given mimetypes, the first of which
+        is the one named in the error message
         """
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Check if supplied mimetype is in the Accept header
+            # Check if a supplied mimetype is in the Accept header
             # If yes, continue the route as usual
-            if mimetype in request.accept_mimetypes:
-                return func(*args, **kwargs)
+            for mimetype in mimetypes:
+                if mimetype in request.accept_mimetypes:
+                    return func(*args, **kwargs)
             # If no, then a response with JSON message and 406 status code is sent
-            message = "Request must accept {} data".format(mimetype)
+            message = "Request must accept {} data".format(mimetypes[0])
             data = json.dumps({"message": message})
             return Response(data, 406, mimetype="application/json")
         return wrapper
@@ -36,4 +42,117 @@ def require(mimetype):
             data = json.dumps({"message": message})
             return Response(data, 415, mimetype="application/json")
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
+
+def json_body(validator, max_size):
+    def decorator(func):
+        """
+        Decorator which reads the JSON request body into g.data.  It returns
+        a 413 Request Entity Too Large if the body is longer than the
+        'max_size' setting, before any of it is parsed, a 400 Bad Request if
+        it is not JSON, and a 422 Unprocessable Entity if it does not match
+        the validator.
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            # Check the declared length, then read at most one byte more
+            # than the limit in case the length was not declared
+            limit = current_app.config[max_size]
+            length = request.content_length
+            body = b""
+            if length is None or length <= limit:
+                body = request.stream.read(limit + 1)
+            if len(body) > limit or (length is not None and length > limit):
+                message = "Request body must be at most {} bytes".format(limit)
+                data = json.dumps({"message": message})
+                return Response(data, 413, mimetype="application/json")
+            
+            try:
+                g.data = json.loads(body.decode("utf-8"))
+            except ValueError:
+                data = json.dumps({"message": "Request body is not valid JSON"})
+                return Response(data, 400, mimetype="application/json")
+            
+            message = validation.first_error(validator, g.data)
+            if message is not None:
+                data = json.dumps({"message": message})
+                return Response(data, 422, mimetype="application/json")
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def client_id():
+    """
+    Identify the client making a request by its address, or by the first
+    address in X-Forwarded-For when the app runs behind a trusted proxy
+    """
+    if current_app.config["RATE_LIMIT_TRUST_PROXY"]:
+        forwarded = request.headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.remote_addr or "unknown"
+
+def retry_after(seconds):
+    """ Value of the Retry-After header, in whole seconds """
+    return str(int(math.ceil(seconds)))
+
+def rate_limit(setting="RATE_LIMIT"):
+    def decorator(func):
+        """
+        Decorator which returns a 429 Too Many Requests once a client makes
+        requests to the route faster than the (rate, burst) in the
+        'setting', a token bucket refilling at 'rate' requests a second
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            limit = current_app.config[setting]
+            if limit is not None:
+                rate, burst = limits.check_rate_limit(limit)
+                key = "{}:{}".format(client_id(), func.__name__)
+                wait = limits.limiter.take(key, rate, burst)
+                if wait:
+                    message = "Too many requests, retry in {} seconds".format(
+                        retry_after(wait))
+                    data = json.dumps({"message": message})
+                    headers = {"Retry-After": retry_after(wait)}
+                    return Response(data, 429, headers=headers,
+                                    mimetype="application/json")
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def concurrency_limit(setting="MAX_IN_FLIGHT"):
+    def decorator(func):
+        """
+        Decorator which returns a 503 Service Unavailable instead of
+        starting more database work once the number of requests in flight
+        reaches the 'setting'.  The count is shared by every route using
+        the same setting, and a streamed response stays in flight until it
+        has been sent.
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            limit = current_app.config[setting]
+            if limit is None:
+                return func(*args, **kwargs)
+            
+            limiter = limits.get_concurrency(setting)
+            if not limiter.acquire(limit):
+                message = "Server is busy, retry later"
+                data = json.dumps({"message": message})
+                headers = {"Retry-After": retry_after(
+                    current_app.config["MAX_IN_FLIGHT_RETRY_AFTER"])}
+                return Response(data, 503, headers=headers,
+                                mimetype="application/json")
+            try:
+                response = func(*args, **kwargs)
+            except Exception:
+                limiter.release()
+                raise
+            if getattr(response, "is_streamed", False):
+                response.call_on_close(limiter.release)
+            else:
+                limiter.release()
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,64 @@
+import hashlib
+
+from flask import Response
+from werkzeug.http import quote_etag
+
+def post_etag(id, version, fields=None):
+    """
+    Strong entity tag for a single post, which changes with each edit and
+    differs for each set of fields other than the full representation
+    """
+    if fields:
+        return "{}-{}-{}".format(id, version, ".".join(fields))
+    return "{}-{}".format(id, version)
+
+# Content codings a representation may be compressed with, each of which
+# gets its own strong entity tag
+ENCODINGS = ("br", "gzip")
+
+def encoded_etag(etag, encoding):
+    """ Strong entity tag for a representation compressed with 'encoding' """
+    return "{}-{}".format(etag, encoding)
+
+def post_version(etag, id):
+    """
+    The version of the post 'id' named by a tag for its full
+    representation, compressed or not, or None for any other tag
+    """
+    prefix = "{}-".format(id)
+    if not etag.startswith(prefix):
+        return None
+    version = etag[len(prefix):]
+    for encoding in ENCODINGS:
+        if version.endswith("-" + encoding):
+            version = version[:-len(encoding) - 1]
+    if not version.isdigit():
+        return None
+    return int(version)
+
+def none_match(if_none_match, etag):
+    """
+    Whether an If-None-Match header names the representation tagged 'etag'
+    or a compressed form of it, compared weakly
+    """
+    return any(if_none_match.contains_weak(tag)
+               for tag in [etag] + [encoded_etag(etag, encoding)
+                                    for encoding in ENCODINGS])
+
+def page_etag(key, rows):
+    """
+    Strong entity tag for a page of posts, built from the normalized query
+    string and the id and version of each post on the page
+    """
+    digest = hashlib.sha1(key.encode("utf-8"))
+    for id, version in rows:
+        digest.update("{}-{};".format(id, version).encode("ascii"))
+    return digest.hexdigest()
+
+def header(etag):
+    """ Value of the ETag header for an entity tag """
+    return quote_etag(etag)
+
+def not_modified(etag):
+    """ A 304 Not Modified response for a representation the client has """
+    return Response(status=304, headers={"ETag": header(etag)})
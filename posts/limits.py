@@ -0,0 +1,135 @@
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from posts import app
+
+class MemoryLimiter(object):
+    """
+    Token buckets held in this process, for at most 'max_keys' clients and
+    routes, forgetting the least recently used bucket when full.  A
+    forgotten bucket starts again full, which only ever lets a client
+    through.
+    """
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+
+    def take(self, key, rate, burst):
+        """
+        Take a token from the bucket for a key, which refills at 'rate'
+        tokens a second up to 'burst' tokens.  Returns the number of seconds
+        until a token is available, which is 0 if one was taken.
+        """
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+# Token bucket applied atomically in Redis, returning whether a token was
+# taken and the tokens left
+REDIS_TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local taken = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    taken = 1
+end
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "updated", ARGV[3])
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return {taken, tostring(tokens)}
+"""
+
+class RedisLimiter(object):
+    """
+    Token buckets shared between processes through Redis, or through any
+    client object with the same register_script method
+    """
+    def __init__(self, url=None, client=None, prefix="posts:limit:"):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("The redis package is required for "
+                                   "the redis rate limit backend")
+            client = redis.StrictRedis.from_url(url)
+        self.script = client.register_script(REDIS_TAKE)
+        self.prefix = prefix
+
+    def take(self, key, rate, burst):
+        now = "{:.6f}".format(time.time())
+        taken, tokens = self.script(keys=[self.prefix + key],
+                                    args=[rate, burst, now])
+        if int(taken):
+            return 0
+        return (1 - float(tokens)) / rate
+
+class ConcurrencyLimiter(object):
+    """ Counts the requests in flight, admitting at most 'limit' at once """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    def acquire(self, limit):
+        """ Admit a request, returning False if 'limit' are in flight """
+        with self.lock:
+            if self.in_flight >= limit:
+                return False
+            self.in_flight += 1
+        return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+def check_rate_limit(limit):
+    """
+    Check that a rate limit setting is a (rate, burst) with a positive
+    rate and room for at least one request, returning the pair
+    """
+    rate, burst = limit
+    if not rate > 0 or not burst >= 1:
+        raise ValueError("Rate limit {!r} must have a positive rate and a "
+                         "burst of at least 1".format(limit))
+    return rate, burst
+
+def make_limiter(config):
+    """ Create the rate limit backend named in the config """
+    backend = config["RATE_LIMIT_BACKEND"]
+    if backend == "memory":
+        return MemoryLimiter(config["RATE_LIMIT_MAX_KEYS"])
+    if backend == "redis":
+        return RedisLimiter(url=config["RATE_LIMIT_REDIS_URL"])
+    raise ValueError("Unknown rate limit backend {}".format(backend))
+
+limiter = make_limiter(app.config)
+if app.config["RATE_LIMIT"] is not None:
+    check_rate_limit(app.config["RATE_LIMIT"])
+
+# Requests in flight, counted once for all the routes sharing a setting
+concurrency = {}
+concurrency_lock = threading.Lock()
+
+def get_concurrency(setting):
+    """ Get the concurrency limiter shared by the routes using a setting """
+    with concurrency_lock:
+        return concurrency.setdefault(setting, ConcurrencyLimiter())
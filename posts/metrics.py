@@ -0,0 +1,212 @@
+import os
+import time
+import cProfile
+import threading
+
+from flask import request, Response, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import cache
+import writebehind
+import compression
+from posts import app
+from database import engine
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the buckets counting queries made by a single request
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+class Counter(object):
+    """ Prometheus counter with a value for each combination of labels """
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} counter".format(self.name)]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append("{}{} {}".format(
+                    self.name, format_labels(self.labels, labels), value))
+        return lines
+
+class Histogram(object):
+    """ Prometheus histogram with a series for each combination of labels """
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0, 0]
+            counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.series.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append("{}_bucket{} {}".format(
+                        self.name,
+                        format_labels(self.labels, labels, [("le", bound)]),
+                        bucket))
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    format_labels(self.labels, labels, [("le", "+Inf")]),
+                    count))
+                lines.append("{}_sum{} {}".format(
+                    self.name, format_labels(self.labels, labels), total))
+                lines.append("{}_count{} {}".format(
+                    self.name, format_labels(self.labels, labels), count))
+        return lines
+
+def render_gauge(name, help, label, values):
+    """
+    Render a gauge from a dictionary mapping the value of its one label to
+    the value of the gauge
+    """
+    lines = ["# HELP {} {}".format(name, help),
+             "# TYPE {} gauge".format(name)]
+    for key, value in sorted(values.items()):
+        lines.append("{}{} {}".format(name, format_labels([label], [key]),
+                                      value))
+    return lines
+
+request_duration = Histogram(
+    "posts_request_duration_seconds",
+    "Time spent handling requests, by view and method",
+    labels=("endpoint", "method"))
+requests_total = Counter(
+    "posts_requests_total",
+    "Requests handled, by view and response status",
+    labels=("endpoint", "status"))
+query_duration = Histogram(
+    "posts_sql_query_duration_seconds",
+    "Time spent executing SQL statements")
+queries_per_request = Histogram(
+    "posts_sql_queries_per_request",
+    "SQL statements executed while handling a request, by view",
+    labels=("endpoint",), buckets=QUERY_COUNT_BUCKETS)
+slow_queries_total = Counter(
+    "posts_sql_slow_queries_total",
+    "SQL statements slower than SLOW_QUERY_THRESHOLD")
+
+def before_cursor_execute(connection, cursor, statement, parameters, context,
+                          executemany):
+    # The start is kept on the execution context, which is discarded with
+    # the statement even if it fails
+    context.query_start = time.time()
+
+def after_cursor_execute(connection, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.time() - context.query_start
+    threshold = app.config["SLOW_QUERY_THRESHOLD"]
+    if threshold is not None and elapsed >= threshold:
+        slow_queries_total.inc()
+        app.logger.warning("Slow query took %.3fs: %s %r",
+                           elapsed, statement, parameters)
+    query_duration.observe(elapsed)
+    # Count the statements made on behalf of the current request, which
+    # shows up N+1 query patterns
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+
+def watch_queries():
+    """
+    Time every SQL statement while METRICS_ENABLED is set, and leave the
+    statements alone otherwise.  Call again after changing the setting.
+    """
+    enabled = app.config["METRICS_ENABLED"]
+    if enabled != event.contains(Engine, "before_cursor_execute",
+                                 before_cursor_execute):
+        change = event.listen if enabled else event.remove
+        change(Engine, "before_cursor_execute", before_cursor_execute)
+        change(Engine, "after_cursor_execute", after_cursor_execute)
+
+watch_queries()
+
+@app.before_request
+def start_request():
+    g.request_start = time.time()
+    # Profile this request if profiling is enabled and the client asked
+    if app.config["PROFILE_ENABLED"] and request.headers.get("X-Profile"):
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+@app.after_request
+def finish_request(response):
+    profile = g.get("profile")
+    if profile is not None:
+        profile.disable()
+        filename = os.path.join(app.config["PROFILE_DIR"], "{}-{:.6f}.prof"
+                                .format(request.endpoint, time.time()))
+        profile.dump_stats(filename)
+        response.headers["X-Profile-File"] = filename
+    if app.config["METRICS_ENABLED"]:
+        endpoint = request.endpoint or "unknown"
+        request_duration.observe(time.time() - g.request_start,
+                                 endpoint, request.method)
+        requests_total.inc(endpoint, response.status_code)
+        queries_per_request.observe(g.get("query_count", 0), endpoint)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def metrics_get():
+    """ Metrics in the Prometheus text exposition format """
+    if not app.config["METRICS_ENABLED"]:
+        return Response("Metrics are disabled\n", 404, mimetype="text/plain")
+    
+    lines = []
+    for metric in [request_duration, requests_total, query_duration,
+                   queries_per_request, slow_queries_total]:
+        lines.extend(metric.render())
+    
+    lines.extend(render_gauge("posts_boot_seconds",
+                              "Time taken to import the app", "name",
+                              {"import": app.boot_seconds}))
+    lines.extend(render_gauge("posts_db_pool", "Connection pool counters",
+                              "name", engine.pool.metrics.as_dictionary()))
+    lines.extend(render_gauge("posts_cache", "Response cache counters",
+                              "name", cache.responses.stats()))
+    
+    lines.extend(render_gauge("posts_compression_cache",
+                              "Compressed response cache counters", "name",
+                              compression.compressed.stats()))
+    if writebehind.writer is not None:
+        pending = writebehind.writer.queue.pending()
+        lines.extend(render_gauge("posts_write_behind",
+                                  "Posts waiting to be written", "name",
+                                  {"pending": pending}))
+    
+    return Response("\n".join(lines) + "\n", 200,
+                    mimetype="text/plain; version=0.0.4")
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Sequence
+from sqlalchemy import (Column, Integer, String, DateTime, Sequence, DDL,
+                        Table, event, func)
 
 from database import Base
 
@@ -8,6 +9,10 @@ class Post(Base):
     id = Column(Integer, primary_key=True)
     title = Column(String(128))
     body = Column(String(1024))
+    # Incremented by every edit, for entity tags and optimistic concurrency
+    version = Column(Integer, nullable=False, default=1)
+    
+    __mapper_args__ = {"version_id_col": version}
     
     def as_dictionary(self):
         post = {
@@ -15,4 +20,200 @@ class Post(Base):
             "title": self.title,
             "body": self.body
         }
-        return post
\ No newline at end of file
+        return post
+
+def post_columns(fields, preview_length):
+    """
+    Columns to select for a representation of posts with the given fields,
+    always including the id and version.  The 'preview' field is the start
+    of the body, cut short by the database.
+    """
+    columns = [Post.id, Post.version]
+    if "title" in fields:
+        columns.append(Post.title)
+    if "body" in fields:
+        columns.append(Post.body)
+    if "preview" in fields:
+        columns.append(func.substr(Post.body, 1, preview_length).label("preview"))
+    return columns
+
+# Text searched by full-text queries on PostgreSQL.  Queries must use exactly
+# the same expression as the index for the planner to pick the index up.
+SEARCH_VECTOR = ("to_tsvector('english', coalesce(title, '') || ' ' || "
+                 "coalesce(body, ''))")
+
+# On PostgreSQL, full-text search uses a GIN index over the search vector
+event.listen(Post.__table__, "after_create",
+             DDL("CREATE INDEX ix_posts_search ON posts "
+                 "USING gin ({})".format(SEARCH_VECTOR))
+             .execute_if(dialect="postgresql"))
+
+# On SQLite, full-text search uses an FTS5 table which indexes the posts
+# table and is kept up to date by triggers
+sqlite_search_ddl = [
+    "CREATE VIRTUAL TABLE posts_fts USING fts5("
+    "title, body, content='posts', content_rowid='id')",
+    "CREATE TRIGGER posts_fts_insert AFTER INSERT ON posts BEGIN "
+    "INSERT INTO posts_fts (rowid, title, body) "
+    "VALUES (new.id, new.title, new.body); END",
+    "CREATE TRIGGER posts_fts_delete AFTER DELETE ON posts BEGIN "
+    "INSERT INTO posts_fts (posts_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); END",
+    "CREATE TRIGGER posts_fts_update AFTER UPDATE ON posts BEGIN "
+    "INSERT INTO posts_fts (posts_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); "
+    "INSERT INTO posts_fts (rowid, title, body) "
+    "VALUES (new.id, new.title, new.body); END"
+]
+for statement in sqlite_search_ddl:
+    event.listen(Post.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Post.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS posts_fts").execute_if(dialect="sqlite"))
+
+# Lower bounds of the length buckets counted in the post_stats summary table
+LENGTH_BUCKETS = {
+    "title": (0, 16, 32, 64, 96),
+    "body": (0, 64, 128, 256, 512, 768)
+}
+
+# Rows each count is spread over.  Concurrent writers on PostgreSQL add to
+# a random slot each, so they rarely wait on the same row lock, and the
+# slots are summed when read.  SQLite has one writer at a time, so only
+# uses the first slot.
+STATS_SLOTS = 16
+
+# Number of posts in each length bucket of each field, kept up to date by
+# triggers so that statistics never need to scan the posts table
+post_stats = Table("post_stats", Base.metadata,
+                   Column("field", String(16), primary_key=True),
+                   Column("bucket", Integer, primary_key=True),
+                   Column("slot", Integer, primary_key=True, default=0),
+                   Column("count", Integer, nullable=False, default=0))
+
+def length_bucket(field, row):
+    """ SQL for the length bucket of a field of the row 'new' or 'old' """
+    length = "length(coalesce({}.{}, ''))".format(row, field)
+    cases = " ".join("WHEN {} >= {} THEN {}".format(length, bound, bound)
+                     for bound in reversed(LENGTH_BUCKETS[field][1:]))
+    return "CASE {} ELSE 0 END".format(cases)
+
+def count_stats(row, change, slot="0"):
+    """
+    SQL adding 'change' to the buckets of the row 'new' or 'old', in the
+    slot given by the SQL 'slot'
+    """
+    return ("UPDATE post_stats SET count = count + ({}) WHERE slot = {} AND "
+            "((field = 'title' AND bucket = {}) OR "
+            "(field = 'body' AND bucket = {}));".format(
+                change, slot, length_bucket("title", row),
+                length_bucket("body", row)))
+
+sqlite_stats_ddl = [
+    "CREATE TRIGGER posts_stats_insert AFTER INSERT ON posts BEGIN "
+    "{} END".format(count_stats("new", 1)),
+    "CREATE TRIGGER posts_stats_delete AFTER DELETE ON posts BEGIN "
+    "{} END".format(count_stats("old", -1)),
+    "CREATE TRIGGER posts_stats_update AFTER UPDATE OF title, body ON posts "
+    "BEGIN {} {} END".format(count_stats("old", -1), count_stats("new", 1))
+]
+
+postgresql_stats_ddl = [
+    "CREATE OR REPLACE FUNCTION posts_stats() RETURNS trigger AS $$ "
+    "DECLARE stats_slot integer := floor(random() * {}); BEGIN "
+    "IF TG_OP IN ('UPDATE', 'DELETE') THEN {} END IF; "
+    "IF TG_OP IN ('INSERT', 'UPDATE') THEN {} END IF; "
+    "RETURN NULL; END $$ LANGUAGE plpgsql".format(
+        STATS_SLOTS, count_stats("OLD", -1, "stats_slot"),
+        count_stats("NEW", 1, "stats_slot")),
+    "CREATE TRIGGER posts_stats AFTER INSERT OR DELETE OR UPDATE OF title, body "
+    "ON posts FOR EACH ROW EXECUTE PROCEDURE posts_stats()"
+]
+
+@event.listens_for(Base.metadata, "after_create")
+def create_stats(metadata, connection, tables=(), **kwargs):
+    """
+    Fill in the summary table from any existing posts once it has been
+    created, then start keeping it up to date
+    """
+    if post_stats not in tables:
+        return
+    connection.execute(post_stats.insert(),
+                       [{"field": field, "bucket": bound, "slot": slot,
+                         "count": 0}
+                        for field, bounds in LENGTH_BUCKETS.items()
+                        for bound in bounds
+                        for slot in range(STATS_SLOTS)])
+    for field in LENGTH_BUCKETS:
+        connection.execute(
+            "UPDATE post_stats SET count = (SELECT count(*) FROM posts "
+            "WHERE {} = post_stats.bucket) WHERE field = '{}' "
+            "AND slot = 0".format(length_bucket(field, "posts"), field))
+    if connection.dialect.name == "sqlite":
+        statements = sqlite_stats_ddl
+    elif connection.dialect.name == "postgresql":
+        statements = postgresql_stats_ddl
+    else:
+        statements = []
+    for statement in statements:
+        connection.execute(statement)
+
+# Append-only log of every change to the posts, in the order the changes
+# were made, written by triggers in the same transaction as the change
+post_changes = Table("post_changes", Base.metadata,
+                     Column("seq", Integer, primary_key=True),
+                     Column("post_id", Integer, nullable=False),
+                     # "create", "update" or "delete", or "compacted" for
+                     # the oldest entry once older entries have been removed
+                     Column("op", String(16), nullable=False),
+                     Column("version", Integer),
+                     Column("changed", DateTime, nullable=False),
+                     # Never reuse the sequence numbers of removed entries
+                     sqlite_autoincrement=True)
+
+def log_change(row, op, now):
+    """ SQL logging a change to the row 'new' or 'old' at the time 'now' """
+    return ("INSERT INTO post_changes (post_id, op, version, changed) "
+            "VALUES ({row}.id, '{op}', {row}.version, {now});".format(
+                row=row, op=op, now=now))
+
+sqlite_changes_ddl = [
+    "CREATE TRIGGER posts_changes_insert AFTER INSERT ON posts BEGIN "
+    "{} END".format(log_change("new", "create", "CURRENT_TIMESTAMP")),
+    "CREATE TRIGGER posts_changes_update AFTER UPDATE ON posts BEGIN "
+    "{} END".format(log_change("new", "update", "CURRENT_TIMESTAMP")),
+    "CREATE TRIGGER posts_changes_delete AFTER DELETE ON posts BEGIN "
+    "{} END".format(log_change("old", "delete", "CURRENT_TIMESTAMP"))
+]
+
+# Changes are logged as each transaction commits, by a deferred trigger,
+# under an advisory lock held only until the commit completes.  Sequence
+# numbers therefore become visible in order, so a reader never skips past
+# a change still to be committed, while writers only queue for the lock
+# as they commit rather than for their whole transaction.  No row lock is
+# taken once the lock is held, so it cannot deadlock with them.
+postgresql_changes_ddl = [
+    "CREATE OR REPLACE FUNCTION posts_changes() RETURNS trigger AS $$ BEGIN "
+    "PERFORM pg_advisory_xact_lock('post_changes'::regclass::oid::bigint); "
+    "IF TG_OP = 'INSERT' THEN {} "
+    "ELSIF TG_OP = 'UPDATE' THEN {} "
+    "ELSE {} END IF; "
+    "RETURN NULL; END $$ LANGUAGE plpgsql".format(
+        log_change("NEW", "create", "(now() AT TIME ZONE 'utc')"),
+        log_change("NEW", "update", "(now() AT TIME ZONE 'utc')"),
+        log_change("OLD", "delete", "(now() AT TIME ZONE 'utc')")),
+    "CREATE CONSTRAINT TRIGGER posts_changes "
+    "AFTER INSERT OR UPDATE OR DELETE ON posts "
+    "DEFERRABLE INITIALLY DEFERRED "
+    "FOR EACH ROW EXECUTE PROCEDURE posts_changes()"
+]
+
+@event.listens_for(Base.metadata, "after_create")
+def create_changes(metadata, connection, tables=(), **kwargs):
+    """ Start logging changes once the change log has been created """
+    if post_changes not in tables:
+        return
+    statements = {"sqlite": sqlite_changes_ddl,
+                  "postgresql": postgresql_changes_ddl}
+    for statement in statements.get(connection.dialect.name, []):
+        connection.execute(statement)
@@ -0,0 +1,88 @@
+import json
+import base64
+
+from flask import url_for
+from sqlalchemy import and_, or_
+
+from posts import app
+
+def get_limit(value, default="POSTS_PER_PAGE", maximum="POSTS_MAX_PER_PAGE"):
+    """
+    Turn the 'limit' query string argument into a page size, capped at
+    the largest page the server is willing to return.  The 'default' and
+    'maximum' name the settings holding the page sizes.
+    """
+    if value is None:
+        return app.config[default]
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be greater than zero")
+    return min(limit, app.config[maximum])
+
+def encode_cursor(values):
+    """ Encode the sort key of the last row on a page as an opaque token """
+    token = base64.urlsafe_b64encode(json.dumps(values).encode("utf-8"))
+    return token.decode("ascii").rstrip("=")
+
+def decode_cursor(token):
+    """
+    Decode a token made by 'encode_cursor' back into the list of sort key
+    values, or None if no token was supplied
+    """
+    if not token:
+        return None
+    try:
+        # Restore the padding stripped by 'encode_cursor'
+        padded = token + "=" * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii"))
+                            .decode("utf-8"))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("cursor is not valid")
+    if not isinstance(values, list) or not values:
+        raise ValueError("cursor is not valid")
+    return values
+
+def seek(query, keys, after):
+    """
+    Order a query by the sort keys and start it after the row whose key
+    values are 'after'.  Each key is a pair of a column expression and
+    whether it sorts in descending order; the last key must be unique.
+    """
+    query = query.order_by(*[key.desc() if descending else key
+                             for key, descending in keys])
+    if after is None:
+        return query
+    if len(after) != len(keys):
+        raise ValueError("cursor is not valid")
+    try:
+        after = [key.type.python_type(value)
+                 for (key, _), value in zip(keys, after)]
+    except (TypeError, ValueError):
+        raise ValueError("cursor is not valid")
+    
+    # Build (a > x) OR (a = x AND b > y) OR ... so the database can seek
+    # through an index instead of skipping rows with OFFSET
+    clauses = []
+    for position, (key, descending) in enumerate(keys):
+        equal = [previous == value for (previous, _), value
+                 in zip(keys[:position], after[:position])]
+        if descending:
+            beyond = key < after[position]
+        else:
+            beyond = key > after[position]
+        clauses.append(and_(*(equal + [beyond])))
+    return query.filter(or_(*clauses))
+
+def next_link(endpoint, values, args):
+    """
+    Build a Link header value pointing at the page which follows the row
+    with the sort key 'values', keeping the other query string arguments
+    """
+    params = dict((key, value) for key, value in args.items()
+                  if key != "cursor")
+    params["cursor"] = encode_cursor(values)
+    url = url_for(endpoint, _external=True, **params)
+    return '<{}>; rel="next"'.format(url)
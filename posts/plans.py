@@ -0,0 +1,304 @@
+"""
+Explain the queries the API makes for each kind of request.
+
+    python run.py explain --threshold 10000
+    python run.py explain --create
+    python run.py explain --save tests/plans/sqlite.json
+
+Every scenario is requested through the test client while the SELECT
+statements it makes are recorded, and each statement is explained on the
+primary database.  Full scans of tables holding more than the threshold
+of rows are flagged, along with indexes which would serve them.
+"""
+import re
+import json
+import argparse
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import cache
+import pagination
+from posts import app
+from database import engine
+
+# How a statement reads a table: a full "scan", an "ordered" scan which
+# stops at the LIMIT without filtering, an "index" with its name, a
+# "covering" index which holds every column needed, the "rowid" of a SQLite
+# table, or a "virtual" table such as FTS5
+Access = namedtuple("Access", ["table", "method", "index"])
+
+def scenarios(max_id):
+    """ The kinds of request the API serves, with their paths and headers """
+    middle = pagination.encode_cursor([max_id // 2])
+    json_only = [("Accept", "application/json")]
+    return [
+        ("posts_get", "/api/posts", json_only),
+        ("posts_get_cursor", "/api/posts?cursor={}".format(middle), json_only),
+        ("posts_get_title_like", "/api/posts?title_like=post", json_only),
+        ("posts_get_body_like", "/api/posts?body_like=test", json_only),
+        ("posts_get_search", "/api/posts?q=post", json_only),
+        ("posts_get_preview", "/api/posts?fields=id,preview", json_only),
+        ("posts_get_if_none_match", "/api/posts",
+         json_only + [("If-None-Match", '"stale"')]),
+        ("post_get", "/api/posts/{}".format(max_id or 1), json_only),
+        ("posts_stats_get", "/api/posts/stats", json_only),
+        ("posts_stats_get_title_like", "/api/posts/stats?title_like=post",
+         json_only),
+        ("posts_changes_get", "/api/posts/changes?since={}".format(max_id // 2),
+         json_only)
+    ]
+
+# Indexes which serve the scans made by each scenario, by dialect.  A
+# substring match cannot use a b-tree index, but can use a trigram index
+# on PostgreSQL.  SQLite has no such index, so its clients should search
+# with 'q' instead.
+PROPOSALS = {
+    "postgresql": {
+        "posts_get_title_like": [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            "CREATE INDEX ix_posts_title_trgm ON posts "
+            "USING gin (title gin_trgm_ops)"
+        ],
+        "posts_get_body_like": [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            "CREATE INDEX ix_posts_body_trgm ON posts "
+            "USING gin (body gin_trgm_ops)"
+        ],
+        "posts_get_if_none_match": [
+            "CREATE INDEX ix_posts_id_version ON posts (id, version)"
+        ]
+    },
+    "sqlite": {
+        "posts_get_if_none_match": [
+            "CREATE INDEX ix_posts_id_version ON posts (id, version)"
+        ]
+    }
+}
+
+# Scenarios which only read columns an index can hold, and are flagged
+# unless they use a covering index.  Answering If-None-Match only needs the
+# ids and versions of the posts on the page.
+COVERED = set(["posts_get_if_none_match"])
+PROPOSALS["postgresql"]["posts_stats_get_title_like"] = \
+    PROPOSALS["postgresql"]["posts_get_title_like"]
+
+def capture(client, path, headers):
+    """ Request a path, returning the SELECT statements it made """
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context,
+               executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    # Answer from the database rather than the response cache
+    cache.responses.clear()
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        response = client.get(path, headers=headers)
+        response.data
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+    return statements
+
+SQLITE_ACCESS = re.compile(r"^(SCAN|SEARCH)(?: TABLE)? (\w+)(?: AS \w+)?"
+                           r"(?: USING (COVERING )?INDEX (\w+)"
+                           r"| USING (INTEGER PRIMARY KEY)"
+                           r"| (VIRTUAL TABLE))?")
+
+def explain_sqlite(cursor, statement, parameters):
+    cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+    accesses = []
+    for row in cursor.fetchall():
+        match = SQLITE_ACCESS.match(row[-1])
+        if match is None:
+            continue
+        kind, table, covering, index, rowid, virtual = match.groups()
+        if index:
+            accesses.append(Access(table, "covering" if covering else "index",
+                                   index))
+        elif rowid:
+            accesses.append(Access(table, "rowid", None))
+        elif virtual:
+            accesses.append(Access(table, "virtual", None))
+        elif kind == "SEARCH":
+            accesses.append(Access(table, "rowid", None))
+        else:
+            accesses.append(Access(table, "scan", None))
+    return accesses
+
+def explain_postgresql(cursor, statement, parameters):
+    cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    accesses = []
+
+    def bitmap_index(node):
+        # The index scans under a bitmap heap scan name no table, and may be
+        # combined by BitmapAnd or BitmapOr nodes
+        if "Index Name" in node:
+            return node["Index Name"]
+        for child in node.get("Plans", []):
+            index = bitmap_index(child)
+            if index is not None:
+                return index
+        return None
+
+    def visit(node):
+        table = node.get("Relation Name")
+        if node["Node Type"] == "Seq Scan":
+            accesses.append(Access(table, "scan", None))
+        elif node["Node Type"] == "Bitmap Heap Scan":
+            accesses.append(Access(table, "index", bitmap_index(node)))
+            return
+        elif node["Node Type"] == "Index Only Scan":
+            accesses.append(Access(table, "covering", node["Index Name"]))
+        elif "Index Name" in node:
+            accesses.append(Access(table, "index", node["Index Name"]))
+        for child in node.get("Plans", []):
+            visit(child)
+    visit(plan[0]["Plan"])
+    return accesses
+
+def explain(statement, parameters):
+    """ How a statement reads each table, from the database's own plan """
+    explainers = {"sqlite": explain_sqlite,
+                  "postgresql": explain_postgresql}
+    explainer = explainers.get(engine.dialect.name)
+    if explainer is None:
+        raise RuntimeError("Cannot explain queries on {}".format(
+            engine.dialect.name))
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        try:
+            accesses = explainer(cursor, statement, parameters)
+        finally:
+            cursor.close()
+    finally:
+        connection.close()
+
+    # A scan with a LIMIT and nothing to filter on only reads the rows it
+    # returns, as a page of posts in id order does
+    words = statement.upper().split()
+    if "LIMIT" in words and "WHERE" not in words:
+        accesses = [access._replace(method="ordered")
+                    if access.method == "scan" else access
+                    for access in accesses]
+    return accesses
+
+def collect():
+    """
+    Explain every statement made by every scenario, returning a dictionary
+    from each scenario to the accesses of its statements, in order
+    """
+    max_id = engine.execute("SELECT max(id) FROM posts").scalar() or 0
+    client = app.test_client()
+    plans = {}
+    for name, path, headers in scenarios(max_id):
+        plans[name] = [explain(statement, parameters)
+                       for statement, parameters
+                       in capture(client, path, headers)]
+    return plans
+
+def scanned(plans, threshold):
+    """
+    Find the scenarios which fully scan a table holding more than
+    'threshold' rows, or whose first statement reads such a table without
+    the covering index it could use, returning a dictionary from each to
+    the tables
+    """
+    rows = {}
+    flagged = {}
+    for name, statements in sorted(plans.items()):
+        for number, accesses in enumerate(statements):
+            covered = name in COVERED and number == 0
+            for access in accesses:
+                if access.method == "scan" or (covered and
+                                               access.method != "covering"):
+                    if access.table not in rows:
+                        rows[access.table] = engine.execute(
+                            "SELECT count(*) FROM {}".format(access.table)
+                            ).scalar()
+                    if rows[access.table] > threshold:
+                        flagged.setdefault(name, set()).add(access.table)
+    return flagged
+
+def regressions(baseline, plans):
+    """
+    Compare plans with a baseline saved by 'save', returning a message for
+    each statement which now scans a table that it read through an index
+    """
+    messages = []
+    for name, statements in sorted(baseline.items()):
+        current = plans.get(name, [])
+        for number, before in enumerate(statements):
+            after = current[number] if number < len(current) else []
+            indexed = set(table for table, method, index in before
+                          if method != "scan")
+            for access in after:
+                if access.method == "scan" and access.table in indexed:
+                    messages.append("{} statement {} now scans {}".format(
+                        name, number + 1, access.table))
+    return messages
+
+def save(plans, path):
+    with open(path, "w") as output:
+        json.dump(dict((name, [[list(access) for access in accesses]
+                               for accesses in statements])
+                       for name, statements in plans.items()),
+                  output, indent=2, sort_keys=True, separators=(",", ": "))
+        output.write("\n")
+
+def load(path):
+    with open(path) as baseline:
+        return dict((name, [[Access(*access) for access in accesses]
+                            for accesses in statements])
+                    for name, statements in json.load(baseline).items())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="run.py explain",
+                                     description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--threshold", type=int, default=10000,
+                        help="Rows above which a full scan is flagged")
+    parser.add_argument("--create", action="store_true",
+                        help="Create the proposed indexes")
+    parser.add_argument("--baseline", help="Fail if plans regressed from "
+                                           "a file written by --save")
+    parser.add_argument("--save", help="Write the plans as JSON")
+    args = parser.parse_args(argv)
+
+    plans = collect()
+    for name, statements in sorted(plans.items()):
+        print(name)
+        for accesses in statements:
+            print("    " + ", ".join(
+                "{} {}{}".format(access.table, access.method,
+                                 " " + access.index if access.index else "")
+                for access in accesses))
+
+    proposals = PROPOSALS.get(engine.dialect.name, {})
+    flagged = scanned(plans, args.threshold)
+    created = set()
+    for name, tables in sorted(flagged.items()):
+        print("\n{} scans {}".format(name, ", ".join(sorted(tables))))
+        for statement in proposals.get(name, []):
+            print("    " + statement)
+            if args.create and statement not in created:
+                created.add(statement)
+                try:
+                    engine.execute(statement)
+                except Exception as error:
+                    print("    failed: {}".format(error))
+
+    if args.save:
+        save(plans, args.save)
+    if args.baseline:
+        messages = regressions(load(args.baseline), plans)
+        for message in messages:
+            print("REGRESSION: " + message)
+        if messages:
+            raise SystemExit(1)
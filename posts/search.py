@@ -0,0 +1,48 @@
+import re
+
+from sqlalchemy import Float, cast, func, literal_column, type_coerce
+from sqlalchemy.sql import table, column, false
+
+import models
+
+# The FTS5 table kept in step with the posts table on SQLite
+posts_fts = table("posts_fts", column("rowid"), column("rank"))
+
+def terms(q):
+    """ Split a search string into the words it contains """
+    return re.findall(r"\w+", q, re.UNICODE)
+
+def search(query, q, dialect):
+    """
+    Restrict a query for posts to those matching every word in the search
+    string 'q', using the full-text index for the database dialect.
+
+    Returns the filtered query and an expression for the relevance of each
+    post, where a higher value means a better match, or None if the
+    database cannot rank the matches.
+    """
+    words = terms(q)
+    if not words:
+        return query.filter(false()), None
+
+    if dialect == "postgresql":
+        # Match against the expression covered by the GIN index
+        vector = literal_column(models.SEARCH_VECTOR)
+        tsquery = func.plainto_tsquery("english", " ".join(words))
+        rank = cast(func.ts_rank(vector, tsquery), Float)
+        return query.filter(vector.op("@@")(tsquery)), rank
+
+    if dialect == "sqlite":
+        # Quote each word so that it is not read as FTS5 query syntax
+        match = " ".join('"{}"'.format(word) for word in words)
+        query = query.join(posts_fts, posts_fts.c.rowid == models.Post.id).\
+                    filter(literal_column("posts_fts").op("MATCH")(match))
+        # FTS5 ranks with bm25, where lower values are better matches
+        return query, type_coerce(-posts_fts.c.rank, Float)
+
+    # Other databases have no full-text index, so fall back to matching
+    # each word anywhere in the title or body
+    for word in words:
+        query = query.filter(models.Post.title.contains(word) |
+                             models.Post.body.contains(word))
+    return query, None
@@ -0,0 +1,89 @@
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+import cache
+from posts import app
+
+# Fields a client can ask for in a representation of a post, in the order
+# they are written out
+FIELDS = ("id", "title", "body", "preview")
+
+# Fields of the full representation of a post
+DEFAULT_FIELDS = ("id", "title", "body")
+
+def get_encoder(name):
+    """
+    Get the function used to encode JSON: "ujson" or "json" for the
+    standard library, or "auto" for ujson when it is installed
+    """
+    if name == "auto":
+        name = "ujson" if ujson is not None else "json"
+    if name == "ujson":
+        if ujson is None:
+            raise RuntimeError("The ujson package is required for the "
+                               "ujson encoder")
+        return ujson.dumps
+    if name == "json":
+        return json.dumps
+    raise ValueError("Unknown JSON encoder {}".format(name))
+
+dumps = get_encoder(app.config["JSON_ENCODER"])
+
+def parse_fields(value, default=DEFAULT_FIELDS):
+    """
+    Turn the comma separated 'fields' query string argument into a tuple
+    of fields in their canonical order
+    """
+    if value is None:
+        return tuple(default)
+    requested = set(field.strip() for field in value.split(","))
+    for field in sorted(requested):
+        if field not in FIELDS:
+            raise ValueError("Unknown field {}".format(field))
+    return tuple(field for field in FIELDS if field in requested)
+
+def compile_encoder(fields):
+    """
+    Build a function which encodes a row, or any object with the fields as
+    attributes, as a JSON object.  The keys are written into a template
+    once, so encoding a row only encodes its values.
+    """
+    template = "{" + ", ".join('"{}": %s'.format(field)
+                               for field in fields) + "}"
+
+    def encode(row):
+        return template % tuple(dumps(getattr(row, field)) for field in fields)
+    return encode
+
+# Encoders compiled so far, by the fields they encode
+encoders = {}
+
+def get_post_encoder(fields=DEFAULT_FIELDS):
+    """ Get the encoder for a set of fields, compiling it the first time """
+    encoder = encoders.get(fields)
+    if encoder is None:
+        encoder = encoders[fields] = compile_encoder(fields)
+    return encoder
+
+def encode_post(post, fields=DEFAULT_FIELDS):
+    """ Encode a post straight from a row or object """
+    return get_post_encoder(fields)(post)
+
+def post_fragment(row, fields=DEFAULT_FIELDS):
+    """
+    Get the JSON for a row with the post's id, version and the fields,
+    encoding it only if it is not cached
+    """
+    fragment = cache.responses.get_fragment(row.id, row.version, fields)
+    if fragment is None:
+        fragment = encode_post(row, fields)
+        cache.responses.set_fragment(row.id, row.version, fields, fragment)
+    return fragment
+
+def encode_list(fragments):
+    """ Join the JSON for several posts into a JSON array """
+    return "[" + ", ".join(fragments) + "]"
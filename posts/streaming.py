@@ -0,0 +1,49 @@
+from flask import Response, stream_with_context
+
+import serializers
+from posts import app
+
+NDJSON = "application/x-ndjson"
+
+def wants_ndjson(accept_mimetypes):
+    """ Check whether the client prefers NDJSON over a JSON array """
+    best = accept_mimetypes.best_match(["application/json", NDJSON])
+    return best == NDJSON
+
+def stream_posts(posts, ndjson=False, fields=serializers.DEFAULT_FIELDS):
+    """
+    Return a Response which streams the posts from a query for the fields
+    as a JSON array, or as one JSON object per line if 'ndjson' is set.
+
+    Rows are read through a server-side cursor in batches of
+    POSTS_STREAM_BATCH, and each batch is written out before the next one
+    is fetched, so memory use does not grow with the number of posts.
+    """
+    batch_size = app.config["POSTS_STREAM_BATCH"]
+    posts = posts.execution_options(stream_results=True).yield_per(batch_size)
+    encode = serializers.get_post_encoder(fields)
+
+    def generate():
+        if not ndjson:
+            yield "["
+        chunk = []
+        count = 0
+        for post in posts:
+            data = encode(post)
+            if ndjson:
+                data += "\n"
+            elif count:
+                data = ", " + data
+            chunk.append(data)
+            count += 1
+            # Write out a full batch before fetching the next one
+            if len(chunk) >= batch_size:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+        if not ndjson:
+            yield "]"
+
+    mimetype = NDJSON if ndjson else "application/json"
+    return Response(stream_with_context(generate()), 200, mimetype=mimetype)
@@ -0,0 +1,70 @@
+from jsonschema import Draft4Validator
+
+import models
+
+posts = models.Post.__table__
+
+# Longest title and body the database columns hold
+TITLE_LENGTH = posts.c.title.type.length
+BODY_LENGTH = posts.c.body.type.length
+
+# JSON Schema describing the structure of a post
+post_schema = {
+    "type": "object",
+    "properties": {
+        "title" : {"type" : "string", "maxLength": TITLE_LENGTH},
+        "body" : {"type": "string", "maxLength": BODY_LENGTH}
+    },
+    "required" : ["title", "body"]
+}
+
+# JSON Schema describing a batch of operations on posts
+batch_schema = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "op": {"enum": ["create", "update", "delete"]}
+        },
+        "required": ["op"]
+    }
+}
+
+# JSON Schemas describing each kind of operation in a batch
+batch_operation_schemas = {
+    "create": post_schema,
+    "update": {
+        "properties": {
+            "id": {"type": "integer"},
+            "title": {"type": "string", "maxLength": TITLE_LENGTH},
+            "body": {"type": "string", "maxLength": BODY_LENGTH}
+        },
+        "required": ["id", "title", "body"]
+    },
+    "delete": {
+        "properties": {
+            "id": {"type": "integer"}
+        },
+        "required": ["id"]
+    }
+}
+
+def compile_schema(schema):
+    """
+    Check a schema and build its validator, so that requests only pay for
+    validating their data
+    """
+    Draft4Validator.check_schema(schema)
+    return Draft4Validator(schema)
+
+def first_error(validator, data):
+    """ Get the message of the first way the data is invalid, or None """
+    for error in validator.iter_errors(data):
+        return error.message
+    return None
+
+post_validator = compile_schema(post_schema)
+batch_validator = compile_schema(batch_schema)
+batch_operation_validators = dict(
+    (op, compile_schema(schema))
+    for op, schema in batch_operation_schemas.items())
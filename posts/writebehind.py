@@ -0,0 +1,322 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import cache
+import writes
+import database
+from posts import app
+
+class QueueFull(Exception):
+    """ Raised when a queue already holds as many posts as it allows """
+
+class MemoryQueue(object):
+    """
+    Queue of posts waiting to be written, held in this process.  Posts are
+    lost if the process stops before they are written.
+
+    Each post is known by a ticket, whose status stays available for
+    'status_ttl' seconds after the post has been written.
+    """
+    # Posts do not outlive the process, so none are left to resume
+    durable = False
+
+    def __init__(self, max_size, status_ttl=3600):
+        self.max_size = max_size
+        self.status_ttl = status_ttl
+        self.lock = threading.Lock()
+        self.queued = OrderedDict()
+        self.claimed = {}
+        self.created = OrderedDict()
+
+    def put(self, post):
+        with self.lock:
+            if len(self.queued) + len(self.claimed) >= self.max_size:
+                raise QueueFull()
+            ticket = uuid.uuid4().hex
+            self.queued[ticket] = post
+        return ticket
+
+    def claim(self, max_items):
+        """ Take up to 'max_items' posts, oldest first, to be written """
+        with self.lock:
+            items = []
+            while self.queued and len(items) < max_items:
+                ticket, post = self.queued.popitem(last=False)
+                self.claimed[ticket] = post
+                items.append((ticket, post))
+        return items
+
+    def done(self, tickets, ids):
+        """ Record the ids of claimed posts which have been written """
+        now = time.time()
+        with self.lock:
+            for ticket, id in zip(tickets, ids):
+                self.claimed.pop(ticket, None)
+                self.created[ticket] = (id, now)
+            # Forget the oldest statuses once they have expired
+            while self.created:
+                ticket, (id, written) = next(iter(self.created.items()))
+                if written >= now - self.status_ttl:
+                    break
+                del self.created[ticket]
+
+    def release(self, tickets):
+        """ Return claimed posts which could not be written to the queue """
+        with self.lock:
+            released = OrderedDict((ticket, self.claimed.pop(ticket))
+                                   for ticket in tickets
+                                   if ticket in self.claimed)
+            released.update(self.queued)
+            self.queued = released
+
+    def status(self, ticket):
+        """
+        Get ("queued", None) or ("created", id) for a ticket, or None if the
+        ticket is not known
+        """
+        with self.lock:
+            if ticket in self.queued or ticket in self.claimed:
+                return ("queued", None)
+            if ticket in self.created:
+                return ("created", self.created[ticket][0])
+        return None
+
+    def pending(self):
+        with self.lock:
+            return len(self.queued) + len(self.claimed)
+
+class Transaction(object):
+    """
+    Context manager running its block in an immediate SQLite transaction,
+    committed if the block succeeds and rolled back if it fails
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.connection.execute("COMMIT")
+        else:
+            self.connection.execute("ROLLBACK")
+
+class DiskQueue(object):
+    """
+    Queue of posts waiting to be written, kept in a local SQLite file so
+    that queued posts survive a restart and can be shared by the worker
+    processes on a machine.
+
+    A post claimed by a process which stops before writing it is claimed
+    again after 'claim_timeout' seconds.  A post written just before such
+    a stop is written again, so delivery is at least once.
+    """
+    # Posts queued or claimed by an earlier process may be waiting
+    durable = True
+
+    def __init__(self, path, max_size, status_ttl=3600, claim_timeout=60):
+        self.path = path
+        self.max_size = max_size
+        self.status_ttl = status_ttl
+        self.claim_timeout = claim_timeout
+        self.local = threading.local()
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS queue ("
+                               "ticket TEXT PRIMARY KEY, "
+                               "title TEXT, body TEXT, "
+                               "state TEXT NOT NULL, "
+                               "updated REAL NOT NULL, "
+                               "post_id INTEGER)")
+            connection.execute("CREATE INDEX IF NOT EXISTS queue_state "
+                               "ON queue (state, updated)")
+        # Nothing is kept open by the process which created the queue, as
+        # SQLite connections must not be used on both sides of a fork
+        self.local.connection.close()
+        self.local = threading.local()
+
+    def connect(self):
+        """ Get this thread's connection to the queue file """
+        connection = getattr(self.local, "connection", None)
+        # A connection inherited across a fork is left alone, unclosed
+        if getattr(self.local, "pid", None) != os.getpid():
+            connection = None
+        if connection is None:
+            # Transactions are started explicitly, so that a claim can take
+            # the write lock before it reads
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return Transaction(connection)
+
+    def put(self, post):
+        ticket = uuid.uuid4().hex
+        with self.connect() as connection:
+            pending = connection.execute("SELECT count(*) FROM queue "
+                                         "WHERE state != 'created'"
+                                         ).fetchone()[0]
+            if pending >= self.max_size:
+                raise QueueFull()
+            connection.execute("INSERT INTO queue (ticket, title, body, "
+                               "state, updated) "
+                               "VALUES (?, ?, ?, 'queued', ?)",
+                               (ticket, post["title"], post["body"],
+                                time.time()))
+        return ticket
+
+    def claim(self, max_items):
+        now = time.time()
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT ticket, title, body FROM queue "
+                "WHERE state = 'queued' "
+                "OR (state = 'claimed' AND updated < ?) "
+                "ORDER BY rowid LIMIT ?",
+                (now - self.claim_timeout, max_items)).fetchall()
+            connection.executemany("UPDATE queue SET state = 'claimed', "
+                                   "updated = ? WHERE ticket = ?",
+                                   [(now, row[0]) for row in rows])
+        return [(ticket, {"title": title, "body": body})
+                for ticket, title, body in rows]
+
+    def done(self, tickets, ids):
+        now = time.time()
+        with self.connect() as connection:
+            connection.executemany("UPDATE queue SET state = 'created', "
+                                   "updated = ?, post_id = ?, "
+                                   "title = NULL, body = NULL "
+                                   "WHERE ticket = ?",
+                                   [(now, id, ticket)
+                                    for ticket, id in zip(tickets, ids)])
+            connection.execute("DELETE FROM queue WHERE state = 'created' "
+                               "AND updated < ?", (now - self.status_ttl,))
+
+    def release(self, tickets):
+        with self.connect() as connection:
+            connection.executemany("UPDATE queue SET state = 'queued' "
+                                   "WHERE ticket = ? AND state = 'claimed'",
+                                   [(ticket,) for ticket in tickets])
+
+    def status(self, ticket):
+        with self.connect() as connection:
+            row = connection.execute("SELECT state, post_id FROM queue "
+                                     "WHERE ticket = ?", (ticket,)).fetchone()
+        if row is None:
+            return None
+        if row[0] == "created":
+            return ("created", row[1])
+        return ("queued", None)
+
+    def pending(self):
+        with self.connect() as connection:
+            return connection.execute("SELECT count(*) FROM queue "
+                                      "WHERE state != 'created'").fetchone()[0]
+
+class WriteBehind(object):
+    """
+    Writes queued posts to the database in the background, committing as
+    many as 'batch_size' posts in each transaction.  The worker thread is
+    started by the first post queued in each process, so that it is not
+    inherited across a fork.
+    """
+    def __init__(self, queue, batch_size, interval, background=True):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.interval = interval
+        self.background = background
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def put(self, post):
+        """ Queue a post to be written, returning its ticket """
+        ticket = self.queue.put({"title": post["title"],
+                                 "body": post["body"]})
+        self.ready.set()
+        if self.background and self.pid != os.getpid():
+            self.start()
+        return ticket
+
+    def resume(self):
+        """
+        Start writing in the background without waiting for a post to be
+        queued, if the queue can hold posts left by a process which stopped
+        """
+        if self.background and self.queue.durable and self.pid != os.getpid():
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            worker = threading.Thread(target=self.run,
+                                      name="posts-write-behind")
+            worker.daemon = True
+            worker.start()
+
+    def run(self):
+        while True:
+            self.ready.wait(self.interval)
+            self.ready.clear()
+            try:
+                # Keep writing full batches until the queue is drained
+                while self.flush() == self.batch_size:
+                    pass
+            except Exception:
+                app.logger.exception("Writing queued posts failed")
+                time.sleep(self.interval)
+
+    def flush(self):
+        """
+        Write one batch of queued posts in a single transaction, returning
+        the number written
+        """
+        items = self.queue.claim(self.batch_size)
+        if not items:
+            return 0
+        tickets = [ticket for ticket, post in items]
+        try:
+            with database.engine.begin() as connection:
+                ids = writes.create_posts(connection,
+                                          [post for ticket, post in items])
+        except Exception:
+            self.queue.release(tickets)
+            raise
+        self.queue.done(tickets, ids)
+        cache.responses.invalidate(created=ids)
+        return len(items)
+
+def make_writer(config):
+    """ Create the write-behind queue named in the config, if any """
+    backend = config["WRITE_BEHIND"]
+    if backend is None:
+        return None
+    if backend == "memory":
+        queue = MemoryQueue(config["WRITE_BEHIND_QUEUE_SIZE"],
+                            config["WRITE_BEHIND_STATUS_TTL"])
+    elif backend == "disk":
+        queue = DiskQueue(config["WRITE_BEHIND_PATH"],
+                          config["WRITE_BEHIND_QUEUE_SIZE"],
+                          config["WRITE_BEHIND_STATUS_TTL"])
+    else:
+        raise ValueError("Unknown write-behind queue {}".format(backend))
+    return WriteBehind(queue, config["WRITE_BEHIND_BATCH"],
+                       config["WRITE_BEHIND_INTERVAL"])
+
+writer = make_writer(app.config)
+
+@app.before_request
+def resume_writes():
+    # Each process, including each forked worker, starts writing the posts
+    # left in a durable queue as soon as it serves its first request
+    if writer is not None:
+        writer.resume()
@@ -0,0 +1,115 @@
+from sqlalchemy import bindparam, select
+
+import models
+
+posts = models.Post.__table__
+
+# Version of a newly created post
+FIRST_VERSION = posts.c.version.default.arg
+
+# Largest number of rows sent in a single statement, to keep statements and
+# IN lists within what the database drivers handle comfortably
+CHUNK_SIZE = 1000
+
+def chunks(items, size=CHUNK_SIZE):
+    """ Split a list into consecutive lists of at most 'size' items """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def existing_ids(connection, ids):
+    """ Get the subset of post ids which are in the database """
+    found = set()
+    for chunk in chunks(sorted(set(ids))):
+        result = connection.execute(select([posts.c.id])
+                                    .where(posts.c.id.in_(chunk)))
+        found.update(row.id for row in result)
+    return found
+
+def create_posts(connection, rows):
+    """
+    Insert posts from a list of dictionaries with 'title' and 'body' keys,
+    returning the new ids in the same order as the rows
+    """
+    ids = []
+    dialect = connection.dialect
+    if dialect.implicit_returning and dialect.supports_multivalues_insert:
+        # Insert each chunk with one multi-row INSERT ... RETURNING
+        for chunk in chunks(rows):
+            statement = posts.insert().values(chunk).returning(posts.c.id)
+            ids.extend(row.id for row in connection.execute(statement))
+    else:
+        # Without RETURNING the ids can only be read back one row at a time,
+        # but the rows still share a single transaction
+        statement = posts.insert()
+        for row in rows:
+            result = connection.execute(statement, row)
+            ids.append(result.inserted_primary_key[0])
+    return ids
+
+def create_post(connection, title, body):
+    """ Insert a post, returning its id """
+    return create_posts(connection, [{"title": title, "body": body}])[0]
+
+def with_versions(statement, id, versions):
+    """
+    Restrict an UPDATE or DELETE to the post with an id, and when
+    'versions' is not None to the versions listed
+    """
+    statement = statement.where(posts.c.id == id)
+    if versions is not None:
+        statement = statement.where(posts.c.version.in_(versions))
+    return statement
+
+def update_post(connection, id, title, body, versions=None):
+    """
+    Update a post in a single statement, only if its version is one of
+    'versions' when given.  Returns the new version, or None if no post was
+    updated.
+    """
+    if versions is not None and not versions:
+        return None
+    statement = with_versions(posts.update(), id, versions).\
+                    values(title=title, body=body,
+                           version=posts.c.version + 1)
+    if connection.dialect.implicit_returning:
+        row = connection.execute(statement.returning(posts.c.version)).first()
+        return row.version if row is not None else None
+    # Without RETURNING the new version is read back in the same
+    # transaction, which only costs a local query on SQLite
+    if connection.execute(statement).rowcount != 1:
+        return None
+    return connection.execute(select([posts.c.version])
+                              .where(posts.c.id == id)).scalar()
+
+def delete_post(connection, id, versions=None):
+    """
+    Delete a post in a single statement, only if its version is one of
+    'versions' when given.  Returns whether a post was deleted.
+    """
+    if versions is not None and not versions:
+        return False
+    statement = with_versions(posts.delete(), id, versions)
+    if connection.dialect.implicit_returning:
+        return connection.execute(
+            statement.returning(posts.c.id)).first() is not None
+    return connection.execute(statement).rowcount == 1
+
+def update_posts(connection, rows):
+    """
+    Update posts from a list of dictionaries with 'id', 'title' and 'body'
+    keys, using one executemany for each chunk
+    """
+    statement = posts.update().\
+                    where(posts.c.id == bindparam("post_id")).\
+                    values(title=bindparam("title"), body=bindparam("body"),
+                           version=posts.c.version + 1)
+    for chunk in chunks(rows):
+        connection.execute(statement, [{"post_id": row["id"],
+                                        "title": row["title"],
+                                        "body": row["body"]}
+                                       for row in chunk])
+
+def delete_posts(connection, ids):
+    """ Delete the posts with the given ids """
+    for chunk in chunks(ids):
+        connection.execute(posts.delete().where(posts.c.id.in_(chunk)))
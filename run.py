@@ -1,10 +1,26 @@
 import os
+import sys
 from posts import app
+from posts.database import migrate
 
 def run():
     port = int(os.environ.get('PORT', 8080))
-    app.run(host='0.0.0.0', port=port)
+    print("Booted in {:.1f} ms".format(app.boot_seconds * 1000))
+    # Flask 0.10 serves one request at a time unless asked for threads
+    app.run(host='0.0.0.0', port=port, threaded=True)
 
 if __name__ == '__main__':
-    run()
-
+    # 'python run.py migrate' creates the tables, which the server no
+    # longer does as it starts
+    if sys.argv[1:] == ["migrate"]:
+        migrate()
+    # 'python run.py compact' removes changes older than the retention
+    elif sys.argv[1:] == ["compact"]:
+        from posts import changes
+        print("Removed {} changes".format(changes.compact_expired()))
+    # 'python run.py explain' checks the query plans of the API
+    elif sys.argv[1:2] == ["explain"]:
+        from posts import plans
+        plans.main(sys.argv[2:])
+    else:
+        run()
@@ -0,0 +1,33 @@
+# Patch the standard library before anything else is imported, so that
+# sockets, locks and thread-locals all cooperate with the gevent event loop
+from gevent import monkey
+monkey.patch_all()
+
+# Make psycopg2 wait for the database through the event loop instead of
+# blocking the whole process
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import os
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from posts import app
+from posts import writebehind
+
+def run():
+    port = int(os.environ.get('PORT', 8080))
+    # Each connection is handled by a greenlet rather than a thread, so
+    # slow clients only cost memory; the pool bounds how many are served
+    # at once, and the connection pool bounds the database work
+    print("Booted in {:.1f} ms".format(app.boot_seconds * 1000))
+    # Write posts left in a durable queue without waiting for a request
+    if writebehind.writer is not None:
+        writebehind.writer.resume()
+    pool = Pool(app.config["ASYNC_MAX_CONNECTIONS"])
+    server = WSGIServer(('0.0.0.0', port), app, spawn=pool)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,269 @@
+"""
+Serve the app from several worker processes which share one listening
+socket, each answering up to PREFORK_THREADS requests at a time.
+
+    python run_prefork.py
+
+The settings are read from posts.config.PreforkConfig unless CONFIG_PATH
+names another class.
+
+The app is imported once by the master, so a worker starts in
+milliseconds, and every worker replaces the connection pools it inherits
+before it serves anything.  SIGHUP reloads the code without dropping a
+connection: the master runs itself again on the same socket, starts new
+workers, and only then stops the old ones.  SIGTERM and SIGINT stop the
+server once the requests in progress have been answered.
+
+Workers share nothing but the database, so several workers need a
+response cache which is shared or disabled: an edit would only
+invalidate the in-process cache of the worker which made it, and the
+others would serve the old post and ETag until it expired.  The server
+refuses to start otherwise.  Other state stays in each worker:
+
+- the "memory" rate limit backend counts each worker's requests
+  separately, allowing up to the number of workers times the limit;
+- MAX_IN_FLIGHT applies to each worker, shared by its threads;
+- the "memory" write-behind queue only knows the tickets of its own
+  worker, so use the "disk" queue;
+- /metrics reports the worker which answered the scrape.
+"""
+import os
+import sys
+import time
+import errno
+import random
+import signal
+import socket
+import resource
+import threading
+import multiprocessing
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+os.environ.setdefault("CONFIG_PATH", "posts.config.PreforkConfig")
+
+from posts import app
+from posts import writebehind
+from posts.database import dispose_engines
+
+# Set by the master for the new copy of itself it runs on a reload
+LISTENER_FD = "PREFORK_LISTENER_FD"
+OLD_WORKERS = "PREFORK_OLD_WORKERS"
+
+class RequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        # The master's terminal is shared by every worker
+        pass
+
+class Server(ThreadingMixIn, WSGIServer):
+    """
+    WSGI server which serves each request in a thread of its own, up to
+    'threads' at once, and counts the requests it has served
+    """
+    daemon_threads = True
+    served = 0
+
+    def __init__(self, address, handler, threads):
+        WSGIServer.__init__(self, address, handler, bind_and_activate=False)
+        self.threads = threads
+        self.slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        self.served += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request,
+                                                  client_address)
+        finally:
+            self.slots.release()
+
+    def handle_slot(self):
+        """
+        Wait for a free thread, then serve a connection if one arrives
+        before the timeout
+        """
+        self.slots.acquire()
+        served = self.served
+        self.handle_request()
+        if self.served == served:
+            self.slots.release()
+
+    def drain(self):
+        """ Wait for the requests in progress to be answered """
+        for _ in range(self.threads):
+            self.slots.acquire()
+
+def make_server(listener, threads):
+    """ Create a WSGI server accepting connections from a shared socket """
+    server = Server(listener.getsockname(), RequestHandler, threads)
+    server.socket.close()
+    server.socket = listener
+    # As HTTPServer.server_bind would have done for a socket of its own
+    host, port = server.server_address = listener.getsockname()
+    server.server_name = socket.getfqdn(host)
+    server.server_port = port
+    server.setup_environ()
+    server.set_app(app)
+    # Wake up every second to notice being asked to stop
+    server.timeout = 1
+    return server
+
+def peak_rss():
+    """ The largest resident memory of this process, in kilobytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def work(listener):
+    """ Serve requests in a worker until it is stopped or recycled """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(True))
+    # The master decides when workers stop, even on a Ctrl-C in the terminal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    dispose_engines()
+    random.seed()
+    # Write posts left in a durable queue without waiting for a request
+    if writebehind.writer is not None:
+        writebehind.writer.resume()
+
+    # Spread the recycling of workers started together
+    max_requests = app.config["PREFORK_MAX_REQUESTS"]
+    if max_requests:
+        max_requests += random.randint(0, max_requests // 10)
+    max_rss = app.config["PREFORK_MAX_RSS"]
+
+    server = make_server(listener, app.config["PREFORK_THREADS"])
+    while not stopping:
+        # Every worker with a free thread is woken by a new connection, and
+        # those which lose the race to accept it serve nothing.  A worker
+        # whose threads are all busy leaves its connections to the others.
+        server.handle_slot()
+        if max_requests and server.served >= max_requests:
+            break
+        if max_rss and peak_rss() > max_rss:
+            break
+    server.drain()
+
+def spawn(listener):
+    """ Fork a worker, returning its pid """
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            work(listener)
+        except BaseException:
+            app.logger.exception("Worker {} failed".format(os.getpid()))
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+def listen(port):
+    """
+    Open the listening socket, or take over the one left by the master
+    this process replaced
+    """
+    if LISTENER_FD in os.environ:
+        fd = int(os.environ.pop(LISTENER_FD))
+        listener = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('0.0.0.0', port))
+        listener.listen(socket.SOMAXCONN)
+    # A worker which loses the race for a connection must not block on it
+    listener.setblocking(False)
+    return listener
+
+def reap():
+    """ Collect the workers which have exited, returning their pids """
+    exited = []
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as error:
+            if error.errno == errno.ECHILD:
+                break
+            raise
+        if pid == 0:
+            break
+        exited.append(pid)
+    return exited
+
+def stop(pids, timeout):
+    """
+    Ask workers to stop, killing any still running after 'timeout'.
+    Returns the pids of any other workers which exited meanwhile.
+    """
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.time() + timeout
+    running = set(pids)
+    exited = set()
+    while running and time.time() < deadline:
+        exited.update(reap())
+        running.difference_update(exited)
+        time.sleep(0.1)
+    for pid in running:
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+    return exited - set(pids)
+
+def reload(listener, workers):
+    """
+    Run this script again in place of the master, handing over the socket
+    and the workers to stop once their replacements are running
+    """
+    if hasattr(listener, "set_inheritable"):
+        listener.set_inheritable(True)
+    os.environ[LISTENER_FD] = str(listener.fileno())
+    os.environ[OLD_WORKERS] = ",".join(str(pid) for pid in workers)
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+def run():
+    port = int(os.environ.get('PORT', 8080))
+    count = app.config["PREFORK_WORKERS"] or multiprocessing.cpu_count()
+    if count > 1 and app.config["CACHE_BACKEND"] == "lru":
+        raise SystemExit("Set CACHE_BACKEND to 'redis' or None to run {} "
+                         "workers, as an 'lru' cache is not shared between "
+                         "them".format(count))
+    timeout = app.config["PREFORK_GRACEFUL_TIMEOUT"]
+    listener = listen(port)
+    old = [int(pid) for pid in os.environ.pop(OLD_WORKERS, "").split(",")
+           if pid]
+
+    received = []
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum,
+                      lambda signum, frame: received.append(signum))
+
+    print("Booted in {:.1f} ms".format(app.boot_seconds * 1000))
+    sys.stdout.flush()
+    workers = set(spawn(listener) for _ in range(count))
+    if old:
+        # The new workers share the socket already, so nothing is refused
+        # while the old ones finish their requests
+        workers.difference_update(stop(old, timeout))
+
+    while True:
+        if signal.SIGHUP in received:
+            reload(listener, workers)
+        if signal.SIGTERM in received or signal.SIGINT in received:
+            stop(workers, timeout)
+            return
+        # Replace the workers which were recycled or failed
+        workers.difference_update(reap())
+        while len(workers) < count:
+            workers.add(spawn(listener))
+        time.sleep(0.1)
+
+if __name__ == '__main__':
+    run()
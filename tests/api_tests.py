@@ -1,12 +1,19 @@
 import unittest
 import os
 import json
+import gzip
+from StringIO import StringIO
 from urlparse import urlparse
 
 # Configure our app to use the testing databse
 os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
 
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
 from posts import app
+from posts import cache
+from posts import metrics
 from posts import models
 from posts.database import Base, engine, session
 
@@ -19,6 +26,9 @@ class TestAPI(unittest.TestCase):
 
         # Set up the tables in the database
         Base.metadata.create_all(engine)
+        
+        # Start without responses cached by earlier tests
+        cache.responses.clear()
 
     def tearDown(self):
         """ Test teardown """
@@ -312,6 +322,80 @@ class TestAPI(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(data["message"], "'body' is a required property")
     
+    def testTitleTooLong(self):
+        """ Posting a post with a title longer than the database holds """
+        data = {
+            "title": "A" * 129,
+            "body": "Just a test"
+        }
+        
+        response = self.client.post("/api/posts",
+                                   data=json.dumps(data),
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json")]
+                                   )
+        
+        self.assertEqual(response.status_code, 422)
+        
+        data = json.loads(response.data)
+        self.assertTrue(data["message"].endswith("is too long"))
+        self.assertEqual(session.query(models.Post).count(), 0)
+    
+    def testBodyTooLarge(self):
+        """ Posting a request body larger than the server accepts """
+        data = {
+            "title": "Example Post",
+            "body": "A" * app.config["POSTS_MAX_BODY_SIZE"]
+        }
+        
+        response = self.client.post("/api/posts",
+                                   data=json.dumps(data),
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json")]
+                                   )
+        
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.mimetype, "application/json")
+    
+    def testMalformedData(self):
+        """ Posting a request body which is not JSON """
+        response = self.client.post("/api/posts",
+                                   data="{\"title\": ",
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json")]
+                                   )
+        
+        self.assertEqual(response.status_code, 400)
+        
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "Request body is not valid JSON")
+    
+    def testEditPostInvalidData(self):
+        """ Editing a post with an invalid body """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        
+        session.add(postA)
+        session.commit()
+        id = postA.id
+        
+        data = {
+            "title": "Example Post A"
+        }
+        
+        response = self.client.put("/api/posts/{}".format(id),
+                                   data=json.dumps(data),
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json")]
+                                   )
+        
+        self.assertEqual(response.status_code, 422)
+        
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "'body' is a required property")
+        
+        post = session.query(models.Post).get(id)
+        self.assertEqual(post.body, "Just a test")
+    
     def testEditPost(self):
         """ Editing a post """
         postA = models.Post(title="Example Post A", body="Just a test")
@@ -340,5 +424,819 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(post.title, "Change Post")
         self.assertEqual(post.body, "Change test")
         
+
+    def testGetPostsPaginated(self):
+        """ Following the next link through pages of posts """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        postC = models.Post(title="Example Post C", body="Another test")
+        
+        session.add_all([postA, postB, postC])
+        session.commit()
+        
+        response = self.client.get("/api/posts?limit=2",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts],
+                         ["Example Post A", "Example Post B"])
+        
+        # The Link header points at the next page
+        link = response.headers.get("Link")
+        self.assertTrue(link.endswith('; rel="next"'))
+        url = urlparse(link[1:link.index(">")])
+        
+        response = self.client.get("{}?{}".format(url.path, url.query),
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts], ["Example Post C"])
+        
+        # The last page has no next link
+        self.assertEqual(response.headers.get("Link"), None)
+    
+    def testGetPostsPaginatedWithTitle(self):
+        """ Paginating through posts filtered by title """
+        postA = models.Post(title="Post with whistles", body="Just a test")
+        postB = models.Post(title="Post with bells", body="Still a test")
+        postC = models.Post(title="Post with bells and whistles", body="Another test")
+        
+        session.add_all([postA, postB, postC])
+        session.commit()
+        
+        response = self.client.get("/api/posts?title_like=whistles&limit=1",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts], ["Post with whistles"])
+        
+        link = response.headers.get("Link")
+        url = urlparse(link[1:link.index(">")])
+        self.assertIn("title_like=whistles", url.query)
+        
+        response = self.client.get("{}?{}".format(url.path, url.query),
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts],
+                         ["Post with bells and whistles"])
+        self.assertEqual(response.headers.get("Link"), None)
+    
+    def testGetPostsInvalidCursor(self):
+        """ Getting posts with a cursor which was not issued by the API """
+        response = self.client.get("/api/posts?cursor=not-a-cursor",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.mimetype, "application/json")
+        
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "cursor is not valid")
+    
+    def testGetPostsLimitCapped(self):
+        """ Asking for a page larger than the server allows """
+        max_per_page = app.config["POSTS_MAX_PER_PAGE"]
+        app.config["POSTS_MAX_PER_PAGE"] = 1
+        try:
+            postA = models.Post(title="Example Post A", body="Just a test")
+            postB = models.Post(title="Example Post B", body="Still a test")
+            
+            session.add_all([postA, postB])
+            session.commit()
+            
+            response = self.client.get("/api/posts?limit=100",
+                                      headers=[("Accept", "application/json")]
+                                      )
+            
+            posts = json.loads(response.data)
+            self.assertEqual(len(posts), 1)
+            self.assertNotEqual(response.headers.get("Link"), None)
+        finally:
+            app.config["POSTS_MAX_PER_PAGE"] = max_per_page
+
+    def testGetPostsStreamed(self):
+        """ Streaming all posts as a JSON array """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        
+        session.add_all([postA, postB])
+        session.commit()
+        
+        response = self.client.get("/api/posts?stream=1&limit=1",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        
+        # The page size does not apply to a streamed export
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts],
+                         ["Example Post A", "Example Post B"])
+    
+    def testGetPostsNDJSON(self):
+        """ Streaming posts filtered by title as NDJSON """
+        postA = models.Post(title="Post with bells", body="Just a test")
+        postB = models.Post(title="Post with whistles", body="Still a test")
+        postC = models.Post(title="Post with bells and whistles", body="Another test")
+        
+        session.add_all([postA, postB, postC])
+        session.commit()
+        
+        response = self.client.get("/api/posts?title_like=whistles",
+                                  headers=[("Accept", "application/x-ndjson")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        
+        lines = response.data.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])["title"], "Post with whistles")
+        self.assertEqual(json.loads(lines[1])["title"],
+                         "Post with bells and whistles")
+
+    def testGetPostsSearch(self):
+        """ Searching posts for every word in a query """
+        postA = models.Post(title="Post with bells", body="Just a test")
+        postB = models.Post(title="Post with whistles", body="Still a test")
+        postC = models.Post(title="Post with bells and whistles", body="Another test")
+        
+        session.add_all([postA, postB, postC])
+        session.commit()
+        
+        response = self.client.get("/api/posts?q=whistles%20BELLS",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        
+        posts = json.loads(response.data)
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(posts[0]["title"], "Post with bells and whistles")
+    
+    def testGetPostsSearchPaginated(self):
+        """ Paginating through search results together with a filter """
+        postA = models.Post(title="Post with bells", body="Just a test")
+        postB = models.Post(title="Post with whistles", body="Still a test")
+        postC = models.Post(title="Post with bells and whistles", body="Another test")
+        
+        session.add_all([postA, postB, postC])
+        session.commit()
+        
+        titles = []
+        url = "/api/posts?q=test&body_like=a%20test&limit=1"
+        while url:
+            response = self.client.get(url,
+                                      headers=[("Accept", "application/json")]
+                                      )
+            self.assertEqual(response.status_code, 200)
+            titles.extend(post["title"] for post in json.loads(response.data))
+            
+            link = response.headers.get("Link")
+            url = None
+            if link:
+                link = urlparse(link[1:link.index(">")])
+                url = "{}?{}".format(link.path, link.query)
+        
+        self.assertEqual(sorted(titles), ["Post with bells", "Post with whistles"])
+
+    def testGetPostsFields(self):
+        """ Getting posts with only some of their fields """
+        postA = models.Post(title="Example Post A", body="A" * 200)
+        postB = models.Post(title="Example Post B", body="Just a test")
+        
+        session.add_all([postA, postB])
+        session.commit()
+        
+        response = self.client.get("/api/posts?fields=id,preview",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        
+        posts = json.loads(response.data)
+        self.assertEqual(len(posts), 2)
+        self.assertEqual(sorted(posts[0].keys()), ["id", "preview"])
+        self.assertEqual(posts[0]["preview"], "A" * 140)
+        self.assertEqual(posts[1]["preview"], "Just a test")
+        
+        # The full representation is unaffected by the cached fragments
+        response = self.client.get("/api/posts",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        posts = json.loads(response.data)
+        self.assertEqual(sorted(posts[0].keys()), ["body", "id", "title"])
+        self.assertEqual(posts[0]["body"], "A" * 200)
+    
+    def testGetPostFields(self):
+        """ Getting a single post with only some of its fields """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        
+        session.add(postA)
+        session.commit()
+        id = postA.id
+        
+        response = self.client.get("/api/posts/{}".format(id),
+                                  headers=[("Accept", "application/json")]
+                                  )
+        etag = response.headers.get("ETag")
+        
+        response = self.client.get("/api/posts/{}?fields=title".format(id),
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers.get("ETag"), etag)
+        
+        post = json.loads(response.data)
+        self.assertEqual(post, {"title": "Example Post A"})
+    
+    def testGetPostsUnknownField(self):
+        """ Asking for a field which posts do not have """
+        response = self.client.get("/api/posts?fields=id,author",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 400)
+        
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "Unknown field author")
+    
+    def testGetPostsStats(self):
+        """ Counting posts without listing them """
+        postA = models.Post(title="Post with bells", body="Just a test")
+        postB = models.Post(title="Post with whistles", body="B" * 100)
+        postC = models.Post(title="Post with bells and whistles",
+                            body="Another test")
+        
+        session.add_all([postA, postB, postC])
+        session.commit()
+        idB = postB.id
+        
+        # Edits and deletes made outside the ORM are counted too
+        response = self.client.delete("/api/posts/{}".format(postC.id),
+                                      headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        session.execute(models.Post.__table__.update().
+                        where(models.Post.id == idB).values(body="Short"))
+        session.commit()
+        
+        response = self.client.get("/api/posts/stats?q=bells",
+                                   headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        
+        data = json.loads(response.data)
+        self.assertEqual(data["count"], 2)
+        self.assertEqual(data["matches"], 1)
+        self.assertEqual(data["title_length"][:2],
+                         [{"min": 0, "max": 15, "count": 1},
+                          {"min": 16, "max": 31, "count": 1}])
+        self.assertEqual(data["body_length"][0],
+                         {"min": 0, "max": 63, "count": 2})
+        self.assertEqual(data["body_length"][-1]["max"], None)
+        self.assertEqual(sum(bucket["count"]
+                             for bucket in data["body_length"]), 2)
+    
+    def testGetPostsCompressed(self):
+        """ Getting posts with gzip compression """
+        posts = [models.Post(title="Example Post {}".format(number),
+                             body="Just a test")
+                 for number in range(50)]
+        
+        session.add_all(posts)
+        session.commit()
+        
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json"),
+                                            ("Accept-Encoding", "gzip")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+        self.assertIn("Accept-Encoding", response.headers.get("Vary"))
+        etag = response.headers.get("ETag")
+        self.assertTrue(etag.startswith('"'))
+        self.assertTrue(etag.endswith('-gzip"'))
+        
+        data = gzip.GzipFile(fileobj=StringIO(response.data)).read()
+        posts = json.loads(data)
+        self.assertEqual(len(posts), 50)
+        
+        # The tag of the compressed page still matches the page, and the
+        # 304 carries the tag and Vary header the 200 had
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json"),
+                                            ("Accept-Encoding", "gzip"),
+                                            ("If-None-Match", etag)]
+                                  )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers.get("ETag"), etag)
+        self.assertIn("Accept-Encoding", response.headers.get("Vary"))
+        
+        response = self.client.get("/api/posts/{}".format(posts[0]["id"]),
+                                   headers=[("Accept", "application/json"),
+                                            ("Accept-Encoding", "gzip")]
+                                  )
+        etag = response.headers.get("ETag")
+        response = self.client.get("/api/posts/{}".format(posts[0]["id"]),
+                                   headers=[("Accept", "application/json"),
+                                            ("Accept-Encoding", "gzip"),
+                                            ("If-None-Match", etag)]
+                                  )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers.get("ETag"), etag)
+        self.assertIn("Accept-Encoding", response.headers.get("Vary"))
+    
+    def testCompressedPostReusedId(self):
+        """ A post reusing a deleted post's id is not served its bytes """
+        def get_post(id):
+            response = self.client.get("/api/posts/{}".format(id),
+                                       headers=[("Accept", "application/json"),
+                                                ("Accept-Encoding", "gzip")]
+                                      )
+            self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+            data = gzip.GzipFile(fileobj=StringIO(response.data)).read()
+            return json.loads(data)
+        
+        postA = models.Post(title="Example Post A", body="A" * 2000)
+        session.add(postA)
+        session.commit()
+        id = postA.id
+        self.assertEqual(get_post(id)["title"], "Example Post A")
+        
+        session.delete(postA)
+        session.commit()
+        cache.responses.clear()
+        postB = models.Post(id=id, title="Example Post B", body="B" * 2000)
+        session.add(postB)
+        session.commit()
+        self.assertEqual(get_post(id)["title"], "Example Post B")
+    
+    def testGetPostsNotCompressed(self):
+        """ Small responses and clients without gzip are not compressed """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        
+        session.add(postA)
+        session.commit()
+        
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json"),
+                                            ("Accept-Encoding", "gzip")]
+                                  )
+        self.assertEqual(response.headers.get("Content-Encoding"), None)
+        
+        response = self.client.get("/api/posts?limit=1",
+                                   headers=[("Accept", "application/json"),
+                                            ("Accept-Encoding", "identity")]
+                                  )
+        self.assertEqual(response.headers.get("Content-Encoding"), None)
+        self.assertEqual(json.loads(response.data)[0]["title"],
+                         "Example Post A")
+    
+    def testStreamPostsCompressed(self):
+        """ Streaming posts with gzip compression """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        
+        session.add_all([postA, postB])
+        session.commit()
+        
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/x-ndjson"),
+                                            ("Accept-Encoding", "gzip")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+        
+        data = gzip.GzipFile(fileobj=StringIO(response.data)).read()
+        lines = data.strip().split("\n")
+        self.assertEqual([json.loads(line)["title"] for line in lines],
+                         ["Example Post A", "Example Post B"])
+    
+    def testSessionRemovedAfterRequest(self):
+        """ Each request gets a fresh session which is discarded afterwards """
+        checkouts = engine.pool.metrics.checkouts
+        
+        response = self.client.get("/api/posts",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(session.registry.has())
+        self.assertTrue(engine.pool.metrics.checkouts > checkouts)
+        self.assertEqual(engine.pool.metrics.checked_out, 0)
+
+    def testBatch(self):
+        """ Creating, updating and deleting posts in one batch """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        
+        session.add_all([postA, postB])
+        session.commit()
+        idA, idB = postA.id, postB.id
+        
+        data = [
+            {"op": "create", "title": "Example Post C", "body": "Another test"},
+            {"op": "update", "id": idA, "title": "Change Post", "body": "Change test"},
+            {"op": "delete", "id": idB},
+            {"op": "delete", "id": idB},
+            {"op": "create", "title": "Example Post D", "body": "Last test"}
+        ]
+        
+        response = self.client.post("/api/posts/batch",
+                                   data=json.dumps(data),
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json")]
+                                   )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        
+        results = json.loads(response.data)
+        self.assertEqual([result["status"] for result in results],
+                         [201, 200, 200, 404, 201])
+        self.assertEqual(results[3]["message"],
+                         "Could not find post with id {}".format(idB))
+        
+        posts = session.query(models.Post).order_by(models.Post.id).all()
+        self.assertEqual([(post.id, post.title) for post in posts],
+                         [(idA, "Change Post"),
+                          (results[0]["id"], "Example Post C"),
+                          (results[4]["id"], "Example Post D")])
+    
+    def testBatchInvalidData(self):
+        """ A batch with an invalid operation is rejected as a whole """
+        data = [
+            {"op": "create", "title": "Example Post", "body": "Just a test"},
+            {"op": "create", "title": "Example Post", "body": 32},
+            {"op": "delete"}
+        ]
+        
+        response = self.client.post("/api/posts/batch",
+                                   data=json.dumps(data),
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json")]
+                                   )
+        
+        self.assertEqual(response.status_code, 422)
+        
+        data = json.loads(response.data)
+        self.assertEqual(data["errors"], [
+            {"index": 1, "message": "32 is not of type 'string'"},
+            {"index": 2, "message": "'id' is a required property"}
+        ])
+        self.assertEqual(session.query(models.Post).count(), 0)
+
+    def testGetPostCached(self):
+        """ Getting a post twice is answered from the cache """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        
+        session.add(postA)
+        session.commit()
+        id = postA.id
+        
+        response = self.client.get("/api/posts/{}".format(id),
+                                  headers=[("Accept", "application/json")]
+                                  )
+        self.assertEqual(response.status_code, 200)
+        
+        # Change the post behind the API's back
+        session.query(models.Post).update({"title": "Changed Post"})
+        session.commit()
+        
+        hits = cache.responses.stats()["hits"]
+        response = self.client.get("/api/posts/{}".format(id),
+                                  headers=[("Accept", "application/json")]
+                                  )
+        
+        post = json.loads(response.data)
+        self.assertEqual(post["title"], "Example Post A")
+        self.assertEqual(cache.responses.stats()["hits"], hits + 1)
+    
+    def testEditPostInvalidatesCache(self):
+        """ Editing a post through the API invalidates its cached copies """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        
+        session.add(postA)
+        session.commit()
+        id = postA.id
+        
+        # Cache the post and the listing containing it
+        self.client.get("/api/posts/{}".format(id),
+                        headers=[("Accept", "application/json")])
+        self.client.get("/api/posts",
+                        headers=[("Accept", "application/json")])
+        
+        data = {
+            "title": "Change Post",
+            "body": "Change test"
+        }
+        
+        response = self.client.put("/api/posts/{}".format(id),
+                                  data=json.dumps(data),
+                                  content_type="application/json",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        self.assertEqual(response.status_code, 200)
+        
+        response = self.client.get("/api/posts/{}".format(id),
+                                  headers=[("Accept", "application/json")]
+                                  )
+        self.assertEqual(json.loads(response.data)["title"], "Change Post")
+        
+        response = self.client.get("/api/posts",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        self.assertEqual(json.loads(response.data)[0]["title"], "Change Post")
+    
+    def testPostPostInvalidatesLastPage(self):
+        """ A new post only invalidates the last page of a listing """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        
+        session.add_all([postA, postB])
+        session.commit()
+        
+        self.client.get("/api/posts?limit=1",
+                        headers=[("Accept", "application/json")])
+        self.client.get("/api/posts",
+                        headers=[("Accept", "application/json")])
+        self.assertEqual(cache.responses.stats()["pages"], 2)
+        
+        data = {
+            "title": "Example Post C",
+            "body": "Another test"
+        }
+        
+        self.client.post("/api/posts",
+                         data=json.dumps(data),
+                         content_type="application/json",
+                         headers=[("Accept", "application/json")])
+        
+        # The full first page is still cached
+        self.assertEqual(cache.responses.stats()["pages"], 1)
+        
+        response = self.client.get("/api/posts",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        self.assertEqual(len(json.loads(response.data)), 3)
+
+    def testGetPostNotModified(self):
+        """ Getting a post with the ETag of the current version """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        
+        session.add(postA)
+        session.commit()
+        id = postA.id
+        
+        response = self.client.get("/api/posts/{}".format(id),
+                                  headers=[("Accept", "application/json")]
+                                  )
+        etag = response.headers.get("ETag")
+        self.assertNotEqual(etag, None)
+        
+        # Answered from the cache
+        response = self.client.get("/api/posts/{}".format(id),
+                                  headers=[("Accept", "application/json"),
+                                           ("If-None-Match", etag)]
+                                  )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        
+        # Answered from the version in the database
+        cache.responses.clear()
+        response = self.client.get("/api/posts/{}".format(id),
+                                  headers=[("Accept", "application/json"),
+                                           ("If-None-Match", etag)]
+                                  )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers.get("ETag"), etag)
+    
+    def testGetPostsNotModified(self):
+        """ Getting a page of posts with the ETag of its current contents """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        
+        session.add_all([postA, postB])
+        session.commit()
+        idB = postB.id
+        
+        response = self.client.get("/api/posts",
+                                  headers=[("Accept", "application/json")]
+                                  )
+        etag = response.headers.get("ETag")
+        
+        cache.responses.clear()
+        response = self.client.get("/api/posts",
+                                  headers=[("Accept", "application/json"),
+                                           ("If-None-Match", etag)]
+                                  )
+        self.assertEqual(response.status_code, 304)
+        
+        # Editing a post on the page changes the ETag
+        post = session.query(models.Post).get(idB)
+        post.title = "Change Post"
+        session.commit()
+        
+        response = self.client.get("/api/posts",
+                                  headers=[("Accept", "application/json"),
+                                           ("If-None-Match", etag)]
+                                  )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers.get("ETag"), etag)
+    
+    def testEditPostIfMatch(self):
+        """ Editing a post with an out of date ETag fails """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        
+        session.add(postA)
+        session.commit()
+        id = postA.id
+        
+        response = self.client.get("/api/posts/{}".format(id),
+                                  headers=[("Accept", "application/json")]
+                                  )
+        etag = response.headers.get("ETag")
+        
+        data = {
+            "title": "Change Post",
+            "body": "Change test"
+        }
+        
+        response = self.client.put("/api/posts/{}".format(id),
+                                  data=json.dumps(data),
+                                  content_type="application/json",
+                                  headers=[("Accept", "application/json"),
+                                           ("If-Match", etag)]
+                                  )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers.get("ETag"), etag)
+        
+        # The second edit with the same ETag is refused
+        response = self.client.put("/api/posts/{}".format(id),
+                                  data=json.dumps(data),
+                                  content_type="application/json",
+                                  headers=[("Accept", "application/json"),
+                                           ("If-Match", etag)]
+                                  )
+        self.assertEqual(response.status_code, 412)
+        
+        data = json.loads(response.data)
+        self.assertEqual(data["message"],
+                         "Post with id {} has been modified".format(id))
+    
+    def testEditPostIfMatchCompressed(self):
+        """ If-Match takes the strong tag of a compressed post, not a weak one """
+        postA = models.Post(title="Example Post A", body="A" * 2000)
+        
+        session.add(postA)
+        session.commit()
+        id = postA.id
+        
+        response = self.client.get("/api/posts/{}".format(id),
+                                  headers=[("Accept", "application/json"),
+                                           ("Accept-Encoding", "gzip")]
+                                  )
+        etag = response.headers.get("ETag")
+        self.assertEqual(etag, '"{}-1-gzip"'.format(id))
+        
+        data = {
+            "title": "Change Post",
+            "body": "Change test"
+        }
+        response = self.client.put("/api/posts/{}".format(id),
+                                  data=json.dumps(data),
+                                  content_type="application/json",
+                                  headers=[("Accept", "application/json"),
+                                           ("If-Match", "W/" + etag)]
+                                  )
+        self.assertEqual(response.status_code, 412)
+        
+        response = self.client.put("/api/posts/{}".format(id),
+                                  data=json.dumps(data),
+                                  content_type="application/json",
+                                  headers=[("Accept", "application/json"),
+                                           ("If-Match", etag)]
+                                  )
+        self.assertEqual(response.status_code, 200)
+    
+    def testDeletePostIfMatch(self):
+        """ Deleting a post with an out of date ETag fails """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        
+        session.add(postA)
+        session.commit()
+        id = postA.id
+        
+        response = self.client.delete("/api/posts/{}".format(id),
+                                  headers=[("Accept", "application/json"),
+                                           ("If-Match", '"{}-0"'.format(id))]
+                                  )
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(session.query(models.Post).count(), 1)
+
+    def testWritesUseOneStatement(self):
+        """ Editing and deleting a post do not read it first """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        
+        session.add(postA)
+        session.commit()
+        id = postA.id
+        
+        statements = []
+        def record(connection, cursor, statement, parameters, context,
+                   executemany):
+            statements.append(statement.lstrip().split()[0].upper())
+        
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            data = {
+                "title": "Change Post",
+                "body": "Change test"
+            }
+            response = self.client.put("/api/posts/{}".format(id),
+                                      data=json.dumps(data),
+                                      content_type="application/json",
+                                      headers=[("Accept", "application/json"),
+                                               ("If-Match", '"{}-1"'.format(id))]
+                                      )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers.get("ETag"),
+                             '"{}-2"'.format(id))
+            self.assertEqual(statements[0], "UPDATE")
+            
+            del statements[:]
+            response = self.client.delete("/api/posts/{}".format(id),
+                                      headers=[("Accept", "application/json"),
+                                               ("If-Match", '"{}-2"'.format(id))]
+                                      )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(statements, ["DELETE"])
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        
+        response = self.client.delete("/api/posts/{}".format(id),
+                                  headers=[("Accept", "application/json")]
+                                  )
+        self.assertEqual(response.status_code, 404)
+
+    def testMetrics(self):
+        """ Request and query timings are served in Prometheus format """
+        app.config["METRICS_ENABLED"] = True
+        metrics.watch_queries()
+        try:
+            self.client.get("/api/posts",
+                            headers=[("Accept", "application/json")])
+            
+            response = self.client.get("/metrics")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, "text/plain")
+            
+            lines = response.data.decode("utf-8").splitlines()
+            self.assertIn('posts_requests_total{endpoint="posts_get",status="200"} 1',
+                          lines)
+            self.assertIn("# TYPE posts_sql_query_duration_seconds histogram",
+                          lines)
+            self.assertTrue(any(line.startswith(
+                'posts_sql_queries_per_request_count{endpoint="posts_get"}')
+                for line in lines))
+        finally:
+            app.config["METRICS_ENABLED"] = False
+            metrics.watch_queries()
+    
+    def testMetricsDisabled(self):
+        """ Metrics are not served or collected unless they are enabled """
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(event.contains(Engine, "before_cursor_execute",
+                                        metrics.before_cursor_execute))
+
+    def testProfileRequest(self):
+        """ A request with an X-Profile header writes out its profile """
+        app.config["PROFILE_ENABLED"] = True
+        try:
+            response = self.client.get("/api/posts",
+                                      headers=[("Accept", "application/json"),
+                                               ("X-Profile", "1")]
+                                      )
+            filename = response.headers.get("X-Profile-File")
+            self.assertTrue(os.path.exists(filename))
+            os.remove(filename)
+        finally:
+            app.config["PROFILE_ENABLED"] = False
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,101 @@
+import unittest
+import os
+import time
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts.cache import LRUCache, ResponseCache, make_cache
+
+class TestLRUCache(unittest.TestCase):
+    """ Tests for the in-process LRU cache """
+
+    def testEvictsLeastRecentlyUsed(self):
+        """ The least recently used value is evicted when the cache is full """
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        
+        # Using 'a' makes 'b' the least recently used value
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats(), {"hits": 3, "misses": 1,
+                                         "evictions": 1, "size": 2})
+
+    def testExpires(self):
+        """ Values are not returned after their TTL """
+        cache = LRUCache(max_size=2, ttl=0.01)
+        cache.set("a", 1)
+        time.sleep(0.02)
+        
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.stats()["size"], 0)
+
+class TestResponseCache(unittest.TestCase):
+    """ Tests for invalidating cached responses """
+
+    def setUp(self):
+        """ Test setup """
+        self.cache = ResponseCache(LRUCache(max_size=10, ttl=60), max_pages=10,
+                                   fragments=LRUCache(max_size=10, ttl=60))
+        self.cache.set_post(2, "post 2")
+        # Two pages of an unfiltered listing, and a filtered last page
+        self.cache.set_page("first", "first", [1, 2], after=None, last=2)
+        self.cache.set_page("last", "last", [3, 4], after=2, last=None)
+        self.cache.set_page("filtered", "filtered", [5], after=None, last=None)
+
+    def cached(self):
+        return [key for key in ["first", "last", "filtered"]
+                if self.cache.get_page(key) is not None]
+
+    def testCreated(self):
+        """ A new post invalidates only the last pages """
+        self.cache.invalidate(created=[6])
+        self.assertEqual(self.cached(), ["first"])
+        self.assertEqual(self.cache.get_post(2), "post 2")
+
+    def testUpdated(self):
+        """ An edited post invalidates itself and the pages covering its id """
+        self.cache.invalidate(updated=[2])
+        self.assertEqual(self.cached(), ["last"])
+        self.assertEqual(self.cache.get_post(2), None)
+
+        self.cache.set_page("first", "first", [1, 2], after=None, last=2)
+        self.cache.invalidate(updated=[4])
+        self.assertEqual(self.cached(), ["first"])
+
+    def testDeleted(self):
+        """ A deleted post invalidates itself and the pages containing it """
+        self.cache.invalidate(deleted=[3])
+        self.assertEqual(self.cached(), ["first", "filtered"])
+
+    def testFragments(self):
+        """ Fragments are only returned for the version they were made from """
+        self.cache.set_fragment(2, 1, ("id", "title"), "version 1")
+        self.assertEqual(self.cache.get_fragment(2, 1, ("id", "title")),
+                         "version 1")
+        self.assertEqual(self.cache.get_fragment(2, 1, ("id",)), None)
+        self.assertEqual(self.cache.get_fragment(2, 2, ("id", "title")), None)
+        
+        # Deleting the post drops its fragments, as the id may be reused
+        self.cache.invalidate(deleted=[2])
+        self.assertEqual(self.cache.get_fragment(2, 1, ("id", "title")), None)
+        
+        # Storing a fragment is not counted as a lookup
+        stats = self.cache.stats()
+        self.assertEqual((stats["fragment_hits"], stats["fragment_misses"]),
+                         (1, 3))
+
+    def testNoFragmentsWithoutCache(self):
+        """ Fragments are not kept when caching is disabled """
+        responses = make_cache({"CACHE_BACKEND": None, "CACHE_MAX_SIZE": 10,
+                                "FRAGMENT_CACHE_SIZE": 10})
+        responses.set_fragment(2, 1, ("id", "title"), "version 1")
+        self.assertEqual(responses.get_fragment(2, 1, ("id", "title")), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts import cache
+from posts import changes
+from posts import models
+from posts.database import Base, engine, session
+
+class TestChanges(unittest.TestCase):
+    """ Tests for the change feed """
+
+    def setUp(self):
+        """ Test setup """
+        self.client = app.test_client()
+
+        # Set up the tables in the database
+        Base.metadata.create_all(engine)
+        
+        cache.responses.clear()
+
+    def tearDown(self):
+        """ Test teardown """
+        session.close()
+        # Remove the tables and their data from the database
+        Base.metadata.drop_all(engine)
+
+    def get_changes(self, query=""):
+        response = self.client.get("/api/posts/changes" + query,
+                                   headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def testChanges(self):
+        """ Creates, updates and deletes are logged in order """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        
+        session.add_all([postA, postB])
+        session.commit()
+        idA, idB = postA.id, postB.id
+        
+        data = {
+            "title": "Edited Post A",
+            "body": "Edited"
+        }
+        response = self.client.put("/api/posts/{}".format(idA),
+                                   data=json.dumps(data),
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        response = self.client.delete("/api/posts/{}".format(idB),
+                                      headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        
+        data = self.get_changes()
+        self.assertEqual([(change["op"], change["id"])
+                          for change in data["changes"]],
+                         [("create", idA), ("create", idB), ("update", idA),
+                          ("delete", idB)])
+        # Only the latest change to a post which still exists carries it,
+        # so that its content matches its version, and tombstones have none
+        self.assertNotIn("post", data["changes"][0])
+        self.assertNotIn("post", data["changes"][1])
+        self.assertEqual(data["changes"][2]["version"], 2)
+        self.assertEqual(data["changes"][2]["post"]["title"], "Edited Post A")
+        self.assertNotIn("post", data["changes"][3])
+        
+        # Syncing again from the last change returns nothing new
+        since = data["since"]
+        self.assertEqual(self.get_changes("?since={}".format(since)),
+                         {"changes": [], "since": since})
+        
+        data = self.get_changes("?since={}&limit=1".format(
+            data["changes"][1]["seq"]))
+        self.assertEqual([change["op"] for change in data["changes"]],
+                         ["update"])
+
+    def testLongPoll(self):
+        """ A request waits for the next change """
+        since = self.get_changes()["since"]
+        
+        def create():
+            time.sleep(0.1)
+            engine.execute(models.Post.__table__.insert(),
+                           {"title": "Example Post", "body": "Just a test"})
+        writer = threading.Thread(target=create)
+        writer.start()
+        
+        app.config["CHANGES_POLL_INTERVAL"] = 0.02
+        try:
+            data = self.get_changes("?since={}&wait=5".format(since))
+        finally:
+            app.config["CHANGES_POLL_INTERVAL"] = 0.5
+            writer.join()
+        
+        self.assertEqual([change["op"] for change in data["changes"]],
+                         ["create"])
+
+    def testBadWait(self):
+        """ Waits which are not a finite, positive number are refused """
+        for wait in ["nan", "inf", "-1", "soon"]:
+            response = self.client.get("/api/posts/changes?wait=" + wait,
+                                       headers=[("Accept", "application/json")])
+            self.assertEqual(response.status_code, 400)
+            data = json.loads(response.data)
+            self.assertEqual(data["message"], "since and wait must be numbers")
+
+    def testCompacted(self):
+        """ Clients behind the compacted changes must sync in full """
+        session.add_all([models.Post(title="Example Post {}".format(number),
+                                     body="Just a test")
+                         for number in range(3)])
+        session.commit()
+        
+        connection = engine.connect()
+        try:
+            removed = changes.compact(connection,
+                                      datetime.utcnow() + timedelta(days=1))
+            compacted = changes.compacted_seq(connection)
+        finally:
+            connection.close()
+        self.assertEqual(removed, 2)
+        
+        response = self.client.get("/api/posts/changes?since=0",
+                                   headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 410)
+        
+        data = self.get_changes("?since={}".format(compacted))
+        self.assertEqual(data["changes"], [])
@@ -0,0 +1,151 @@
+import unittest
+import os
+import time
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts import cache
+from posts import limits
+from posts.limits import MemoryLimiter, ConcurrencyLimiter
+from posts.database import Base, engine, session
+
+class TestMemoryLimiter(unittest.TestCase):
+    """ Tests for the in-process token buckets """
+
+    def testBurst(self):
+        """ A full bucket allows a burst, then asks the client to wait """
+        limiter = MemoryLimiter()
+        self.assertEqual(limiter.take("client", 1, 2), 0)
+        self.assertEqual(limiter.take("client", 1, 2), 0)
+        
+        wait = limiter.take("client", 1, 2)
+        self.assertTrue(0 < wait <= 1)
+        
+        # Other clients have their own buckets
+        self.assertEqual(limiter.take("other", 1, 2), 0)
+
+    def testRefills(self):
+        """ Tokens come back at the rate """
+        limiter = MemoryLimiter()
+        limiter.take("client", 100, 1)
+        self.assertTrue(limiter.take("client", 100, 1) > 0)
+        
+        time.sleep(0.02)
+        self.assertEqual(limiter.take("client", 100, 1), 0)
+
+    def testForgetsLeastRecentlyUsed(self):
+        """ At most 'max_keys' buckets are kept """
+        limiter = MemoryLimiter(max_keys=1)
+        limiter.take("client", 1, 1)
+        limiter.take("other", 1, 1)
+        
+        self.assertEqual(list(limiter.buckets.keys()), ["other"])
+
+    def testCheckRateLimit(self):
+        """ Rate limits which would never refill are refused """
+        self.assertEqual(limits.check_rate_limit((10, 20)), (10, 20))
+        for limit in [(0, 20), (-1, 20), (10, 0)]:
+            self.assertRaises(ValueError, limits.check_rate_limit, limit)
+
+class TestConcurrencyLimiter(unittest.TestCase):
+    """ Tests for counting requests in flight """
+
+    def testLimit(self):
+        """ Requests are refused at the limit until one finishes """
+        limiter = ConcurrencyLimiter()
+        self.assertTrue(limiter.acquire(2))
+        self.assertTrue(limiter.acquire(2))
+        self.assertFalse(limiter.acquire(2))
+        
+        limiter.release()
+        self.assertTrue(limiter.acquire(2))
+
+class TestLimitDecorators(unittest.TestCase):
+    """ Tests for limiting requests to the API """
+
+    def setUp(self):
+        """ Test setup """
+        self.client = app.test_client()
+
+        # Set up the tables in the database
+        Base.metadata.create_all(engine)
+        
+        cache.responses.clear()
+        limits.limiter = MemoryLimiter()
+
+    def tearDown(self):
+        """ Test teardown """
+        app.config["RATE_LIMIT"] = None
+        app.config["MAX_IN_FLIGHT"] = None
+        session.close()
+        Base.metadata.drop_all(engine)
+
+    def testRateLimit(self):
+        """ A client making requests too quickly is told to slow down """
+        app.config["RATE_LIMIT"] = (0.5, 2)
+        
+        for _ in range(2):
+            response = self.client.get("/api/posts",
+                                       headers=[("Accept", "application/json")])
+            self.assertEqual(response.status_code, 200)
+        
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json")])
+        
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers.get("Retry-After"), "2")
+        
+        # Each route has its own limit
+        response = self.client.get("/api/posts/stats",
+                                   headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+
+    def testConcurrencyLimit(self):
+        """ Requests beyond the limit in flight are shed """
+        app.config["MAX_IN_FLIGHT"] = 1
+        limiter = limits.get_concurrency("MAX_IN_FLIGHT")
+        
+        # The limit is shared, so a request in flight on another route
+        # counts against it
+        limiter.acquire(1)
+        try:
+            response = self.client.get("/api/posts",
+                                       headers=[("Accept", "application/json")])
+            stats = self.client.get("/api/posts/stats",
+                                    headers=[("Accept", "application/json")])
+        finally:
+            limiter.release()
+        
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(stats.status_code, 503)
+        self.assertEqual(response.headers.get("Retry-After"), "1")
+        
+        # Single posts and the change feed count too
+        data = '{"title": "Example Post", "body": "Just a test"}'
+        limiter.acquire(1)
+        try:
+            responses = [
+                self.client.get("/api/posts/1",
+                                headers=[("Accept", "application/json")]),
+                self.client.get("/api/posts/changes",
+                                headers=[("Accept", "application/json")]),
+                self.client.post("/api/posts", data=data,
+                                 content_type="application/json",
+                                 headers=[("Accept", "application/json")]),
+                self.client.put("/api/posts/1", data=data,
+                                content_type="application/json",
+                                headers=[("Accept", "application/json")]),
+                self.client.delete("/api/posts/1",
+                                   headers=[("Accept", "application/json")])
+            ]
+        finally:
+            limiter.release()
+        self.assertEqual([response.status_code for response in responses],
+                         [503] * 5)
+        
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(limiter.in_flight, 0)
@@ -0,0 +1,92 @@
+import unittest
+import os
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import models
+from posts import plans
+from posts.plans import Access
+from posts.database import Base, engine, session
+
+# Plans saved with 'python run.py explain --save', one file per dialect
+BASELINES = os.path.join(os.path.dirname(__file__), "plans")
+BASELINE = os.path.join(BASELINES, "{}.json".format(engine.dialect.name))
+
+class PlanCursor(object):
+    """ A cursor which answers EXPLAIN with a saved PostgreSQL plan """
+    def __init__(self, plan):
+        self.plan = plan
+
+    def execute(self, statement, parameters):
+        pass
+
+    def fetchone(self):
+        return [[{"Plan": self.plan}]]
+
+class TestPlans(unittest.TestCase):
+    """ Tests for the query plans of the API """
+
+    def setUp(self):
+        """ Test setup """
+        # Set up the tables in the database
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        """ Test teardown """
+        session.close()
+        # Remove the tables and their data from the database
+        Base.metadata.drop_all(engine)
+
+    @unittest.skipUnless(os.path.exists(BASELINE),
+                         "No baseline plans for {}; save them with 'python "
+                         "run.py explain --save tests/plans/{}.json'".format(
+                             engine.dialect.name, engine.dialect.name))
+    def testNoRegressions(self):
+        """ No query reads through a scan where the baseline used an index """
+        session.add_all([models.Post(title="Example Post {}".format(number),
+                                     body="Just a test")
+                         for number in range(10)])
+        session.commit()
+        
+        self.assertEqual(plans.regressions(plans.load(BASELINE),
+                                           plans.collect()),
+                         [])
+
+    def testRegressions(self):
+        """ A statement which stops using an index is a regression """
+        baseline = {
+            "post_get": [[Access("posts", "rowid", None)]],
+            "posts_get_search": [[Access("posts_fts", "virtual", None),
+                                  Access("posts", "rowid", None)]]
+        }
+        current = {
+            "post_get": [[Access("posts", "scan", None)]],
+            "posts_get_search": [[Access("posts_fts", "virtual", None),
+                                  Access("posts", "index", "ix_posts")]]
+        }
+        
+        self.assertEqual(plans.regressions(baseline, current),
+                         ["post_get statement 1 now scans posts"])
+
+    def testBitmapScan(self):
+        """ A bitmap heap scan reads its table through the index below it """
+        plan = {
+            "Node Type": "Limit",
+            "Plans": [{
+                "Node Type": "Bitmap Heap Scan",
+                "Relation Name": "posts",
+                "Plans": [{
+                    "Node Type": "Bitmap Index Scan",
+                    "Index Name": "ix_posts_title_trgm"
+                }]
+            }]
+        }
+        accesses = plans.explain_postgresql(PlanCursor(plan), "SELECT", {})
+        self.assertEqual(accesses,
+                         [Access("posts", "index", "ix_posts_title_trgm")])
+
+        baseline = {"posts_get_title_like": [accesses]}
+        current = {"posts_get_title_like": [[Access("posts", "scan", None)]]}
+        self.assertEqual(plans.regressions(baseline, current),
+                         ["posts_get_title_like statement 1 now scans posts"])
@@ -0,0 +1,172 @@
+import unittest
+import os
+import json
+import threading
+
+from sqlalchemy import exc
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts import cache
+from posts import models
+from posts import database
+from posts.database import Base, engine, session, make_engine, ReplicaSet
+
+class TestReplicaSet(unittest.TestCase):
+    """ Tests for choosing between read replicas """
+
+    def testRoundRobin(self):
+        """ Healthy replicas take turns """
+        replicaA = make_engine("sqlite://")
+        replicaB = make_engine("sqlite://")
+        replicas = ReplicaSet([replicaA, replicaB])
+        
+        chosen = [replicas.choose() for _ in range(4)]
+        self.assertEqual(chosen, [replicaA, replicaB, replicaA, replicaB])
+
+    def testLeastConnections(self):
+        """ The replica with the fewest connections checked out is chosen """
+        replicaA = make_engine("sqlite://")
+        replicaB = make_engine("sqlite://")
+        replicas = ReplicaSet([replicaA, replicaB], "least_connections")
+        
+        connection = replicaA.connect()
+        try:
+            self.assertEqual(replicas.choose(), replicaB)
+        finally:
+            connection.close()
+
+    def testSkipsUnhealthy(self):
+        """ Replicas which fail their health check are not chosen """
+        replicaA = make_engine("sqlite:////nonexistent/posts-replica.db")
+        replicaB = make_engine("sqlite://")
+        replicas = ReplicaSet([replicaA, replicaB])
+        replicas.check()
+        
+        chosen = [replicas.choose() for _ in range(3)]
+        self.assertEqual(chosen, [replicaB, replicaB, replicaB])
+        
+        replicas = ReplicaSet([replicaA])
+        replicas.check()
+        self.assertEqual(replicas.choose(), None)
+
+    def testChecksInBackground(self):
+        """ Reads do not wait for the health checks """
+        replicaA = make_engine("sqlite://")
+        replicas = ReplicaSet([replicaA])
+        answer = threading.Event()
+        checked = threading.Event()
+        
+        def check():
+            answer.wait(5)
+            ReplicaSet.check(replicas)
+            checked.set()
+        replicas.check = check
+        try:
+            self.assertEqual(replicas.choose(), replicaA)
+            self.assertFalse(checked.is_set())
+        finally:
+            answer.set()
+        self.assertTrue(checked.wait(5))
+
+    def testPoolTimeoutIsUnhealthy(self):
+        """ A replica whose pool has no connection to spare is unhealthy """
+        replica = make_engine("sqlite://")
+        def timeout():
+            raise exc.TimeoutError("QueuePool limit reached")
+        replica.connect = timeout
+        self.assertFalse(database.is_healthy(replica))
+
+class TestReplicaRouting(unittest.TestCase):
+    """ Tests for sending the reads of the API to a replica """
+
+    def setUp(self):
+        """ Test setup """
+        self.client = app.test_client()
+
+        # Set up the tables in the primary and in an empty stand-in replica
+        Base.metadata.create_all(engine)
+        self.replica = make_engine("sqlite://")
+        Base.metadata.create_all(self.replica)
+        self.replicas = database.replicas
+        database.replicas = ReplicaSet([self.replica])
+        
+        cache.responses.clear()
+
+    def tearDown(self):
+        """ Test teardown """
+        database.replicas = self.replicas
+        session.close()
+        Base.metadata.drop_all(engine)
+
+    def testReadsUseReplica(self):
+        """ Reads are answered by the replica, which the primary is ahead of """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        
+        session.add(postA)
+        session.commit()
+        
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), [])
+
+    def testReadYourWrites(self):
+        """ A client's reads stay on the primary just after it writes """
+        data = {
+            "title": "Example Post",
+            "body": "Just a test"
+        }
+        
+        response = self.client.post("/api/posts",
+                                   data=json.dumps(data),
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json")]
+                                   )
+        self.assertEqual(response.status_code, 201)
+        
+        response = self.client.get(response.headers.get("Location"),
+                                   headers=[("Accept", "application/json")]
+                                  )
+        
+        self.assertEqual(response.status_code, 200)
+        post = json.loads(response.data)
+        self.assertEqual(post["title"], "Example Post")
+        
+        # A client without the cookie reads from the replica
+        response = app.test_client().get("/api/posts",
+                                         headers=[("Accept",
+                                                   "application/json")]
+                                        )
+        self.assertEqual(json.loads(response.data), [])
+
+    def testReplicaReadsNotCached(self):
+        """ Pages read from a lagging replica are not served to a writer """
+        data = {
+            "title": "Example Post",
+            "body": "Just a test"
+        }
+        writer = app.test_client()
+        response = writer.post("/api/posts",
+                               data=json.dumps(data),
+                               content_type="application/json",
+                               headers=[("Accept", "application/json")]
+                               )
+        self.assertEqual(response.status_code, 201)
+        
+        # Another client reads the page from the replica, before the write
+        # has reached it
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json")]
+                                  )
+        self.assertEqual(json.loads(response.data), [])
+        
+        response = writer.get("/api/posts",
+                              headers=[("Accept", "application/json")]
+                             )
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts], ["Example Post"])
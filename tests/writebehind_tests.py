@@ -0,0 +1,203 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from urlparse import urlparse
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts import cache
+from posts import models
+from posts import writebehind
+from posts.writebehind import MemoryQueue, DiskQueue, QueueFull, WriteBehind
+from posts.database import Base, engine, session
+
+class QueueTests(object):
+    """ Tests shared by every kind of write-behind queue """
+
+    def testClaimAndDone(self):
+        """ Posts are claimed oldest first, then marked as written """
+        queue = self.make_queue(10)
+        ticketA = queue.put({"title": "Example Post A", "body": "Just a test"})
+        ticketB = queue.put({"title": "Example Post B", "body": "Still a test"})
+        
+        items = queue.claim(1)
+        self.assertEqual(items, [(ticketA, {"title": "Example Post A",
+                                            "body": "Just a test"})])
+        self.assertEqual(queue.status(ticketA), ("queued", None))
+        
+        queue.done([ticketA], [7])
+        self.assertEqual(queue.status(ticketA), ("created", 7))
+        self.assertEqual(queue.status(ticketB), ("queued", None))
+        self.assertEqual(queue.status("unknown"), None)
+        self.assertEqual(queue.pending(), 1)
+
+    def testRelease(self):
+        """ Released posts are claimed again before newer posts """
+        queue = self.make_queue(10)
+        ticketA = queue.put({"title": "Example Post A", "body": "Just a test"})
+        ticketB = queue.put({"title": "Example Post B", "body": "Still a test"})
+        
+        queue.claim(1)
+        queue.release([ticketA])
+        
+        tickets = [ticket for ticket, post in queue.claim(2)]
+        self.assertEqual(tickets, [ticketA, ticketB])
+
+    def testFull(self):
+        """ Posts are refused while the queue is full """
+        queue = self.make_queue(1)
+        ticket = queue.put({"title": "Example Post A", "body": "Just a test"})
+        
+        self.assertRaises(QueueFull, queue.put,
+                          {"title": "Example Post B", "body": "Still a test"})
+        
+        queue.claim(1)
+        queue.done([ticket], [1])
+        queue.put({"title": "Example Post B", "body": "Still a test"})
+
+class TestMemoryQueue(QueueTests, unittest.TestCase):
+    """ Tests for the in-process write-behind queue """
+
+    def make_queue(self, max_size):
+        return MemoryQueue(max_size)
+
+class TestDiskQueue(QueueTests, unittest.TestCase):
+    """ Tests for the write-behind queue kept in a SQLite file """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_queue(self, max_size):
+        return DiskQueue(os.path.join(self.directory, "queue.db"), max_size)
+
+    def testSurvivesRestart(self):
+        """ Queued posts are still queued when the file is opened again """
+        queue = self.make_queue(10)
+        ticket = queue.put({"title": "Example Post A", "body": "Just a test"})
+        
+        queue = self.make_queue(10)
+        self.assertEqual(queue.status(ticket), ("queued", None))
+        self.assertEqual([ticket for ticket, post in queue.claim(10)],
+                         [ticket])
+
+    def testResume(self):
+        """ Writing resumes without a new post only for a durable queue """
+        started = []
+        class Writer(WriteBehind):
+            def start(self):
+                started.append(self.queue)
+        
+        memory = MemoryQueue(10)
+        Writer(memory, batch_size=10, interval=0.05).resume()
+        disk = self.make_queue(10)
+        Writer(disk, batch_size=10, interval=0.05).resume()
+        Writer(disk, batch_size=10, interval=0.05, background=False).resume()
+        self.assertEqual(started, [disk])
+
+    def testFork(self):
+        """ A forked process opens its own connection to the queue """
+        queue = self.make_queue(10)
+        queue.put({"title": "Example Post A", "body": "Just a test"})
+        parent = queue.local.connection
+        
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                queue.put({"title": "Example Post B", "body": "Still a test"})
+                if queue.local.connection is not parent:
+                    code = 0
+            finally:
+                os._exit(code)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(queue.pending(), 2)
+
+class TestWriteBehind(unittest.TestCase):
+    """ Tests for queueing new posts through the API """
+
+    def setUp(self):
+        """ Test setup """
+        self.client = app.test_client()
+
+        # Set up the tables in the database
+        Base.metadata.create_all(engine)
+        
+        cache.responses.clear()
+        
+        # Write the queued posts when the test says so, not in a thread
+        self.writer = writebehind.writer
+        writebehind.writer = WriteBehind(MemoryQueue(2), batch_size=10,
+                                         interval=0.05, background=False)
+
+    def tearDown(self):
+        """ Test teardown """
+        writebehind.writer = self.writer
+        session.close()
+        Base.metadata.drop_all(engine)
+
+    def post(self, title):
+        data = {
+            "title": title,
+            "body": "Just a test"
+        }
+        
+        return self.client.post("/api/posts",
+                                data=json.dumps(data),
+                                content_type="application/json",
+                                headers=[("Accept", "application/json")]
+                                )
+
+    def testQueuedPost(self):
+        """ Posting a post which is written in the background """
+        response = self.post("Example Post")
+        
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.data)
+        self.assertEqual(data["status"], "queued")
+        status_url = response.headers.get("Location")
+        self.assertEqual(urlparse(status_url).path,
+                         "/api/posts/queued/{}".format(data["ticket"]))
+        self.assertEqual(session.query(models.Post).count(), 0)
+        
+        response = self.client.get(status_url,
+                                   headers=[("Accept", "application/json")])
+        self.assertEqual(json.loads(response.data)["status"], "queued")
+        
+        self.assertEqual(writebehind.writer.flush(), 1)
+        
+        response = self.client.get(status_url,
+                                   headers=[("Accept", "application/json")])
+        data = json.loads(response.data)
+        self.assertEqual(data["status"], "created")
+        self.assertEqual(urlparse(response.headers.get("Location")).path,
+                         "/api/posts/{}".format(data["id"]))
+        
+        post = session.query(models.Post).get(data["id"])
+        self.assertEqual(post.title, "Example Post")
+
+    def testQueueFull(self):
+        """ Posting while the queue is full """
+        self.post("Example Post A")
+        self.post("Example Post B")
+        response = self.post("Example Post C")
+        
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get("Retry-After"), "1")
+        
+        # The batch is committed together
+        self.assertEqual(writebehind.writer.flush(), 2)
+        self.assertEqual(session.query(models.Post).count(), 2)
+
+    def testUnknownTicket(self):
+        """ Getting the status of a post which was never queued """
+        response = self.client.get("/api/posts/queued/unknown",
+                                   headers=[("Accept", "application/json")])
+        
+        self.assertEqual(response.status_code, 404)